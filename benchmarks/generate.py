@@ -0,0 +1,141 @@
+"""Generates a synthetic archive of relatives for the benchmarks.
+
+    python3 -m benchmarks.generate <directory> [--people 10000] [--seed 0]
+
+The archive has the layout of a deployment (data/relatives, data/login,
+data/tex) and is built generation by generation: couples marry, some
+remarry after a spouse died, have up to six children, and a few people
+have long biographies.
+"""
+import argparse
+import os
+import random
+import shutil
+
+from genealogy.relatives import format_relative
+
+FIRST_NAMES = {
+  'male': ['Hans', 'Karl', 'Peter', 'Jürgen', 'Friedrich', 'Wilhelm', 'Otto', 'Günther', 'Heinrich', 'Josef',
+           'Franz', 'Walter', 'Klaus', 'Dieter', 'Uwe', 'Matthias', 'Stefan', 'Andreas', 'Michael', 'Jörg'],
+  'female': ['Anna', 'Maria', 'Grete', 'Käthe', 'Elisabeth', 'Ursula', 'Helga', 'Renate', 'Ingrid', 'Gisela',
+             'Monika', 'Brigitte', 'Sabine', 'Petra', 'Claudia', 'Hildegard', 'Martina', 'Anke', 'Birgit', 'Doris'],
+}
+LAST_NAMES = ['Müller', 'Schmidt', 'Schneider', 'Fischer', 'Weber', 'Meyer', 'Wagner', 'Becker', 'Schulz',
+              'Hoffmann', 'Schäfer', 'Koch', 'Bauer', 'Richter', 'Klein', 'Wolf', 'Schröder', 'Neumann',
+              'Schwarz', 'Zimmermann', 'Braun', 'Krüger', 'Hofmann', 'Hartmann', 'Lange', 'Weiß', 'Köhler']
+PLACES = ['München', 'Köln', 'Berlin', 'Hamburg', 'Düsseldorf', 'Straßburg', 'Nürnberg', 'Lübeck', 'Würzburg',
+          'Bremen', 'Göttingen', 'Münster', 'Zürich', 'Wien', 'Graz', 'Augsburg', 'Mönchengladbach']
+PROFESSIONS = ['Bäcker', 'Schmied', 'Lehrerin', 'Lehrer', 'Bauer', 'Ärztin', 'Kaufmann', 'Schneiderin',
+               'Ingenieur', 'Pfarrer', 'Hebamme', 'Zimmermann', 'Müller', 'Förster', '']
+WORDS = ('lebte arbeitete heiratete zog nach kehrte zurück aus dem Krieg wanderte aus erbte den Hof '
+         'gründete eine Werkstatt war bekannt für seine ihre Geduld Musik Gärten Briefe Reisen Kinder '
+         'the family moved to the city after the war and later returned to the village').split()
+
+ASCII = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss'})
+
+USERS = 'admin;Admin;admin@example.com;secret\n'
+TEMPLATE = '\\documentclass{article}\n\\begin{document}\n%<<DEFINE-NODES>>\n%<<DEFINE-HUBS>>\n%<<DEFINE-CONNECTIONS>>\n\\end{document}\n'
+
+
+def date(rng, year):
+  return f'{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.{year}'
+
+def biography(rng):
+  # Most biographies are short, a few are long
+  length = rng.choice([0, 20, 50, 100, 200]) if rng.random() < 0.95 else rng.randint(2000, 10000)
+  paragraphs = []
+  while length > 0:
+    words = min(length, rng.randint(30, 120))
+    paragraphs.append(' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.')
+    length -= words
+  return '\n\n'.join(paragraphs)
+
+class Archive:
+  def __init__(self, rng):
+    self.rng = rng
+    self.people = {}
+
+  def person(self, sex, year, last_name=None, father='', mother=''):
+    rng = self.rng
+    first_name = rng.choice(FIRST_NAMES[sex])
+    last_name = last_name or rng.choice(LAST_NAMES)
+    hash = f'{first_name}-{last_name}-{len(self.people)}'.lower().translate(ASCII)
+    death = year + rng.randint(30, 95)
+    self.people[hash] = {
+      'hash': hash, 'name': f'{first_name} {last_name}', 'sex': sex, 'father': father, 'mother': mother,
+      'spouse': [], 'birthday': date(rng, year) if rng.random() < 0.9 else str(year),
+      'birthplace': rng.choice(PLACES), 'weddingDay': '', 'weddingPlace': '',
+      'dayOfDeath': date(rng, death) if death < 2020 else '', 'placeOfDeath': rng.choice(PLACES) if death < 2020 else '',
+      'profession': rng.choice(PROFESSIONS), 'image': 'unknown.png', 'body': biography(rng), 'year': year,
+    }
+    return hash
+
+  def marry(self, a, b, year):
+    rng = self.rng
+    self.people[a]['spouse'].append(b)
+    self.people[b]['spouse'].append(a)
+    for hash in (a, b):
+      self.people[hash]['weddingDay'] = date(rng, year)
+      self.people[hash]['weddingPlace'] = rng.choice(PLACES)
+
+  def generate(self, count):
+    rng = self.rng
+    year = 1700
+    generation = [self.person(sex, year + rng.randint(-5, 5)) for sex in ['male', 'female'] * max(2, count // 200)]
+    while len(self.people) < count:
+      men = [hash for hash in generation if self.people[hash]['sex'] == 'male']
+      women = [hash for hash in generation if self.people[hash]['sex'] == 'female']
+      rng.shuffle(men)
+      rng.shuffle(women)
+
+      children = []
+      for husband, wife in zip(men, women):
+        couples = [(husband, wife)]
+        # Some remarry, with a spouse from outside the archive
+        if rng.random() < 0.15 and len(self.people) < count:
+          couples.append((husband, self.person('female', self.people[husband]['year'] + rng.randint(0, 15))))
+        for father, mother in couples:
+          wedding = max(self.people[father]['year'], self.people[mother]['year']) + rng.randint(18, 30)
+          self.marry(father, mother, wedding)
+          for _ in range(rng.choice([0, 1, 2, 2, 3, 3, 4, 6])):
+            if len(self.people) >= count:
+              break
+            sex = rng.choice(['male', 'female'])
+            children.append(self.person(sex, wedding + rng.randint(1, 15), self.people[father]['name'].split()[-1], father, mother))
+
+      # People marrying into the family keep the archive growing
+      if not children:
+        children = [self.person(sex, year + 25) for sex in ['male', 'female'] * 10]
+      generation = children + [self.person('female' if self.people[hash]['sex'] == 'male' else 'male',
+                                           self.people[hash]['year'] + rng.randint(-5, 5))
+                               for hash in children if rng.random() < 0.6 and len(self.people) < count]
+      year += 25
+    return self.people
+
+def write_archive(path, people, seed=0):
+  rng = random.Random(seed)
+  archive = Archive(rng).generate(people)
+
+  relatives_dir = os.path.join(path, 'data/relatives')
+  os.makedirs(os.path.join(relatives_dir, 'images/family'), exist_ok=True)
+  os.makedirs(os.path.join(path, 'data/login'), exist_ok=True)
+  os.makedirs(os.path.join(path, 'data/tex'), exist_ok=True)
+  shutil.copy(os.path.join(os.path.dirname(__file__), '../genealogy/static/images/unknown.png'), os.path.join(relatives_dir, 'images'))
+  with open(os.path.join(path, 'data/login/login.md'), 'w') as file:
+    file.write(USERS)
+  with open(os.path.join(path, 'data/tex/template-family.tex'), 'w') as file:
+    file.write(TEMPLATE)
+
+  for relative in archive.values():
+    with open(os.path.join(relatives_dir, f'{relative["hash"]}.md'), 'w') as file:
+      file.write(format_relative(relative))
+  return sorted(archive)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generate a synthetic archive of relatives')
+  parser.add_argument('directory')
+  parser.add_argument('--people', type=int, default=10000)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  hashes = write_archive(args.directory, args.people, args.seed)
+  print(f'{len(hashes)} relatives written to {args.directory}')
@@ -0,0 +1,184 @@
+"""Benchmarks the application on a synthetic archive.
+
+    python3 -m benchmarks.run [--people 1000] [--requests 100] [--storage sqlite] [--save]
+
+Generates an archive (see benchmarks.generate) in a temporary directory,
+drives the routes through Flask's test client and reports latency
+percentiles, throughput and peak memory per scenario. The peak is what the
+scenario's requests allocate on top of what was allocated before, traced
+with tracemalloc in MEMORY_REQUESTS further requests after the timed ones,
+so that tracing doesn't slow those down. pdflatex and
+pdftoppm are replaced by stubs that only create their output files, so
+tree rendering measures the application's own work. With --storage sqlite
+the archive is migrated into a database first. Results are compared with
+benchmarks/baseline-<people>[-sqlite].json, --save replaces that baseline.
+"""
+import argparse
+import gc
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.generate import USERS, write_archive
+from genealogy import app, graph, relatives
+from genealogy.migrate import migrate
+from genealogy.relatives import get_relative, open_repository, open_storage
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline-{people}{suffix}.json')
+PERCENTILES = (50, 90, 99)
+MEMORY_REQUESTS = 10
+
+
+def stub_run(args, cwd=None, **kwargs):
+  # Stands in for pdflatex and pdftoppm in genealogy.graph
+  name = os.path.basename(args[0])
+  if name == 'pdflatex':
+    output = os.path.join(cwd, os.path.splitext(args[-1])[0] + '.pdf')
+  elif name == 'pdftoppm':
+    output = os.path.join(cwd, args[2] + '.png')
+  else:
+    raise RuntimeError(f'unexpected command {args}')
+  with open(output, 'wb') as file:
+    file.write(b'stub')
+  return subprocess.CompletedProcess(args, 0)
+
+def percentile(samples, p):
+  ordered = sorted(samples)
+  return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)]
+
+def scenarios(hashes, rng):
+  # name -> function(client) doing one request
+  def get(url):
+    return lambda client: client.get(url() if callable(url) else url)
+
+  def edit(client):
+    relative = get_relative(rng.choice(hashes))
+    form = dict(relative.meta(), spouse=str(relative['spouse']), body=relative['body'] + '\n\nEdited.')
+    return client.post(f'/relatives/{relative["hash"]}/edit', data=form)
+
+  surnames = ['Müller', 'Schmidt', 'Koch', 'Weiß', 'Lehrer', 'Krieg', 'Würzburg']
+  return {
+    'index': get('/'),
+    'relatives page': get('/relatives'),
+    'relatives json': get(lambda: f'/relatives.json?born_from={rng.randint(1700, 1950)}&born_to={rng.randint(1950, 2000)}&sex=female'),
+    'relative': get(lambda: f'/relatives/{rng.choice(hashes)}'),
+    'ancestors': get(lambda: f'/relatives/{rng.choice(hashes)}/ancestors'),
+    'chart svg': get(lambda: f'/relatives/{rng.choice(hashes)}/chart.svg?up=3&down=3'),
+    'search': lambda client: client.post('/search', data={'query': rng.choice(surnames)}),
+    'validate': get('/validate'),
+    'edit': edit,
+    'tree': get(lambda: f'/generate/{rng.choice(hashes)}'),
+  }
+
+def measure(client, function, requests):
+  samples = []
+  start = time.perf_counter()
+  for _ in range(requests):
+    begin = time.perf_counter()
+    response = function(client)
+    samples.append(time.perf_counter() - begin)
+    if response.status_code >= 400:
+      raise RuntimeError(f'request failed with {response.status}')
+  elapsed = time.perf_counter() - start
+  return samples, elapsed
+
+def peak_memory(client, function, requests):
+  # MiB allocated at most while doing the requests
+  gc.collect()
+  tracemalloc.start()
+  try:
+    start, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for _ in range(requests):
+      function(client)
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return (peak - start) / 2**20
+
+def run(people, requests, seed=0, only=None, storage='markdown'):
+  workspace = tempfile.mkdtemp(prefix='genealogy-benchmark-')
+  cwd = os.getcwd()
+  try:
+    begin = time.perf_counter()
+    hashes = write_archive(workspace, people, seed)
+    print(f'generated {len(hashes)} relatives in {time.perf_counter() - begin:.1f} s', file=sys.stderr)
+    os.chdir(workspace)
+    if storage != 'markdown':
+      begin = time.perf_counter()
+      migrate(open_storage('markdown'), open_storage(storage))
+      print(f'migrated to {storage} in {time.perf_counter() - begin:.1f} s', file=sys.stderr)
+    relatives.repository = open_repository(storage)
+
+    graph.subprocess.run = stub_run
+    client = app.test_client()
+    _, _, email, password = USERS.strip().split(';')
+    client.post('/login', data={'email': email, 'password': password})
+
+    results = {}
+    begin = time.perf_counter()
+    client.get('/relatives/' + hashes[0])
+    results['cold start'] = {'requests': 1, 'p50': time.perf_counter() - begin, 'p90': None, 'p99': None,
+                             'throughput': None, 'memory': None}
+
+    rng = random.Random(seed)
+    for name, function in scenarios(hashes, rng).items():
+      if only and name not in only:
+        continue
+      gc.collect()
+      samples, elapsed = measure(client, function, requests)
+      result = {'requests': requests, 'throughput': requests / elapsed,
+                'memory': peak_memory(client, function, min(requests, MEMORY_REQUESTS))}
+      for p in PERCENTILES:
+        result[f'p{p}'] = percentile(samples, p)
+      results[name] = result
+      print(f'{name}: done', file=sys.stderr)
+    return results
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workspace, ignore_errors=True)
+
+def report(results, baseline):
+  def ms(value):
+    return '' if value is None else f'{value * 1000:.2f}'
+
+  print(f'{"scenario":<16} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"req/s":>9} {"peak MiB":>9} {"p50 vs baseline":>16}')
+  for name, result in results.items():
+    change = ''
+    if name in baseline and baseline[name]['p50']:
+      change = f'{(result["p50"] / baseline[name]["p50"] - 1) * 100:+.0f} %'
+    throughput = f'{result["throughput"]:.1f}' if result['throughput'] else ''
+    memory = f'{result["memory"]:.1f}' if result['memory'] is not None else ''
+    print(f'{name:<16} {ms(result["p50"]):>9} {ms(result["p90"]):>9} {ms(result["p99"]):>9} {throughput:>9} '
+          f'{memory:>9} {change:>16}')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the application on a synthetic archive')
+  parser.add_argument('--people', type=int, default=1000, help='size of the archive, e.g. 1000, 10000 or 100000')
+  parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--only', nargs='*', help='scenarios to run')
+  parser.add_argument('--storage', choices=['markdown', 'sqlite'], default='markdown')
+  parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+  args = parser.parse_args()
+
+  results = run(args.people, args.requests, args.seed, args.only, args.storage)
+  filename = BASELINE.format(people=args.people, suffix='' if args.storage == 'markdown' else f'-{args.storage}')
+  try:
+    with open(filename, 'r') as file:
+      baseline = json.load(file)
+  except OSError:
+    baseline = {}
+  report(results, baseline)
+
+  if args.save:
+    with open(filename, 'w') as file:
+      json.dump(results, file, indent=2)
+    print(f'baseline saved to {filename}', file=sys.stderr)
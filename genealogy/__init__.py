@@ -1,3 +1,5 @@
+import os
+
 from flask import Flask
 import flask_login
 
@@ -6,10 +8,32 @@ app = Flask(__name__)
 # python3 -c 'import secrets; print(secrets.token_hex())'
 app.config['SECRET_KEY'] = '5f5bfb3b1cd072bfa391bfd05e10ba39ec5a365486c79416b97fb88e3fa29495'
 
+# Family tree rendering: number of parallel pdflatex jobs and the time limit
+# in seconds for each external program
+app.config['TREE_WORKERS'] = os.cpu_count() or 1
+app.config['TREE_TIMEOUT'] = 120
+
+# 'tex' renders family trees with pdflatex and pdftoppm and keeps a PDF for
+# printing, 'svg' draws them directly and needs cairosvg
+app.config['TREE_BACKEND'] = 'tex'
+
+# 'markdown' keeps one file per relative in data/relatives/, 'sqlite' keeps
+# them in data/relatives.sqlite; python3 -m genealogy.migrate copies the
+# relatives from one to the other
+app.config['STORAGE'] = 'markdown'
+
+# Dump cProfile statistics of requests slower than this many seconds to
+# data/log/profiles/, None disables profiling
+app.config['PROFILE_SLOW_REQUESTS'] = None
+
 login_manager = flask_login.LoginManager()
 login_manager.init_app(app)
 
 from genealogy import routes
-from genealogy.relatives import get_relative_name
+from genealogy.relatives import get_relative_name, get_relative_names
+from genealogy.thumbnails import thumbnail_srcset, thumbnail_url
 
-app.jinja_env.globals.update(get_relative_name=get_relative_name)
+app.jinja_env.globals.update(get_relative_name=get_relative_name,
+                             get_relative_names=get_relative_names,
+                             thumbnail_srcset=thumbnail_srcset,
+                             thumbnail_url=thumbnail_url)
@@ -0,0 +1,67 @@
+from collections import Counter
+
+
+# Everything generateTexNode and generate_tex take from a relative
+TREE_FIELDS = ['hash', 'name', 'sex', 'father', 'mother', 'spouse', 'birthday', 'birthplace',
+               'weddingDay', 'weddingPlace', 'dayOfDeath', 'placeOfDeath', 'profession', 'image']
+
+
+def tree_signature(relative):
+  return tuple(str(relative.get(field, '')) for field in TREE_FIELDS)
+
+def tree_edges(relative):
+  # The family tree of a person shows the person, the parents, the spouses
+  # and the children; the latter are recorded by the children themselves
+  hash = relative['hash']
+  yield hash, hash
+  for parent in (relative.get('father', ''), relative.get('mother', '')):
+    if parent:
+      yield hash, parent
+      yield parent, hash
+  for spouse in relative.get('spouse', []):
+    if spouse:
+      yield hash, spouse
+
+class DependencyGraph:
+  def __init__(self):
+    self.people = {}     # tree hash -> Counter of the people shown in it
+    self.dependents = {} # person hash -> set of tree hashes showing them
+    self.images = {}     # person hash -> portrait
+
+  def add(self, relative):
+    for tree, person in tree_edges(relative):
+      people = self.people.setdefault(tree, Counter())
+      people[person] += 1
+      self.dependents.setdefault(person, set()).add(tree)
+    self.images[relative['hash']] = relative.get('image', '')
+    return self.trees_showing(relative['hash'])
+
+  def remove(self, relative):
+    trees = self.trees_showing(relative['hash'])
+    for tree, person in tree_edges(relative):
+      people = self.people.get(tree)
+      if not people or not people[person]:
+        continue
+      people[person] -= 1
+      if not people[person]:
+        del people[person]
+        self.dependents[person].discard(tree)
+        if not self.dependents[person]:
+          del self.dependents[person]
+      if not people:
+        del self.people[tree]
+    self.images.pop(relative['hash'], None)
+    return trees
+
+  def trees_showing(self, hash):
+    return set(self.dependents.get(hash, ()))
+
+  def portraits(self):
+    return set(self.images.values()) - {''}
+
+  def trees_using_images(self, images):
+    trees = set()
+    for person, portrait in self.images.items():
+      if portrait in images:
+        trees |= self.trees_showing(person)
+    return trees
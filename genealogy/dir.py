@@ -1,4 +1,6 @@
 import os
+import threading
+from contextlib import contextmanager
 
 def createDirIfNeeded(dir):
   if not os.path.exists(dir):
@@ -7,3 +9,21 @@ def createDirIfNeeded(dir):
 def createFileIfNeeded(dir, filename):
   createDirIfNeeded(dir)
   open(os.path.join(dir, filename), 'a').close() # make sure it exists
+
+@contextmanager
+def replaceFile(filename, mode='w'):
+  # Yields a temporary file that replaces filename once the block is done,
+  # so that readers never see a partly written file; the temporary file is
+  # removed if the block fails
+  createDirIfNeeded(os.path.dirname(filename) or '.')
+  tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+  try:
+    with open(tmp, mode) as file:
+      yield file
+    os.replace(tmp, filename)
+  except BaseException:
+    try:
+      os.remove(tmp)
+    except OSError:
+      pass
+    raise
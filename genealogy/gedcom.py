@@ -0,0 +1,305 @@
+import re
+import sys
+
+from genealogy.relatives import BATCH_SIZE, empty_relative, relative_exists, repository
+
+# GEDCOM 5.5.1 import and export. Both stream record by record: the
+# importer reads the file twice, first only the families and names to
+# resolve the links, then the individuals, which are written in batches.
+# The exporter yields the file in chunks. Exported individuals carry their
+# hash as REFN of type REFN_TYPE, so importing them again replaces them;
+# individuals of other files get new hashes.
+
+CHUNK_SIZE = 64 * 1024
+LINE_LENGTH = 200
+REFN_TYPE = 'genealogy'
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+SEXES = {'M': 'male', 'F': 'female'}
+
+LINE = re.compile(r'\s*(\d+)\s+(?:(@[^@]+@)\s+)?(\S+)(?: (.*))?')
+HASH = re.compile(r'[\w-][\w.-]*')
+ASCII = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss', 'Ä': 'ae', 'Ö': 'oe', 'Ü': 'ue'})
+
+
+def records(lines):
+  # Yields every level 0 record as (xref, tag, value, [(path, value)]),
+  # with CONT and CONC lines joined to the value they continue
+  record = None
+  stack = []
+  for line in lines:
+    match = LINE.fullmatch(line.rstrip('\r\n').lstrip('\ufeff'))
+    if not match:
+      continue
+    level, xref, tag, value = int(match[1]), match[2], match[3], match[4] or ''
+    if level == 0:
+      if record is not None:
+        yield record
+      record = (xref, tag, value, [])
+      stack = []
+    elif record is not None:
+      fields = record[3]
+      if tag in ('CONT', 'CONC') and fields:
+        path, previous = fields[-1]
+        fields[-1] = (path, previous + ('\n' if tag == 'CONT' else '') + value)
+        continue
+      del stack[level - 1:]
+      stack.append(tag)
+      fields.append((tuple(stack), value))
+  if record is not None:
+    yield record
+
+def first(fields, *path):
+  for field, value in fields:
+    if field == path:
+      return value
+  return ''
+
+def every(fields, *path):
+  return [value for field, value in fields if field == path]
+
+def import_date(text):
+  # 1 MAR 1900 -> 01.03.1900, MAR 1900 -> 03.1900, anything else unchanged
+  match = re.fullmatch(r'(?:(\d{1,2}) )?(?:([A-Z]{3}) )?(\d{3,4})', text.strip().upper())
+  if not match or (match[2] and match[2] not in MONTHS) or (match[1] and not match[2]):
+    return text.strip()
+  day, month, year = match.groups()
+  parts = [f'{int(day):02d}'] if day else []
+  parts += [f'{MONTHS.index(month) + 1:02d}'] if month else []
+  return '.'.join(parts + [year])
+
+def export_date(text):
+  match = re.fullmatch(r'(?:(?:(\d{1,2})\.)?(\d{1,2})\.)?(\d{3,4})', text.strip())
+  if not match:
+    return f'({text})' if text else ''
+  day, month, year = match.groups()
+  if month and not 1 <= int(month) <= 12:
+    return f'({text})'
+  parts = [str(int(day))] if day else []
+  parts += [MONTHS[int(month) - 1]] if month else []
+  return ' '.join(parts + [year])
+
+def import_name(text):
+  return ' '.join(text.replace('/', ' ').split())
+
+def slugify(text):
+  return re.sub(r'[^a-z0-9]+', '-', text.lower().translate(ASCII)).strip('-')
+
+def make_hash(name, xref):
+  # The hash names the file of the relative, so the xref is slugified just
+  # like the name
+  parts = [part for part in (slugify(name), slugify(xref)) if part]
+  return '-'.join(parts) or 'relative'
+
+def exported_hash(fields):
+  # The hash of an individual exported from here, None for others
+  for (path, value), following in zip(fields, fields[1:] + [((), '')]):
+    if path == ('REFN',) and following == (('REFN', 'TYPE'), REFN_TYPE) and HASH.fullmatch(value):
+      return value
+  return None
+
+def new_hash(name, xref, taken):
+  # Never one of an existing relative, those are only replaced by their own
+  # export
+  hash = make_hash(name, xref)
+  candidate = hash
+  n = 1
+  while candidate in taken or relative_exists(candidate):
+    n += 1
+    candidate = f'{hash}-{n}'
+  return candidate
+
+def checked_hash(hash):
+  # Every hash of an import ends up in a filename
+  if not HASH.fullmatch(hash):
+    raise ValueError(f'invalid hash {hash!r}')
+  return hash
+
+def read_links(lines):
+  # First pass: hashes of the individuals and the links of the families
+  hashes = {}
+  parents = {}
+  spouses = {}
+  weddings = {}
+  taken = set()
+  for xref, tag, _, fields in records(lines):
+    if tag == 'INDI' and xref:
+      hashes[xref] = checked_hash(exported_hash(fields) or new_hash(import_name(first(fields, 'NAME')), xref, taken))
+      taken.add(hashes[xref])
+    elif tag == 'FAM':
+      husband, wife = first(fields, 'HUSB'), first(fields, 'WIFE')
+      for child in every(fields, 'CHIL'):
+        parents.setdefault(child, (husband, wife))
+      if husband and wife:
+        spouses.setdefault(husband, []).append(wife)
+        spouses.setdefault(wife, []).append(husband)
+      wedding = (import_date(first(fields, 'MARR', 'DATE')), first(fields, 'MARR', 'PLAC'))
+      if any(wedding):
+        for partner in (husband, wife):
+          if partner:
+            weddings[partner] = wedding
+  return hashes, parents, spouses, weddings
+
+def read_relatives(lines, links):
+  # Second pass: one relative per individual
+  hashes, parents, spouses, weddings = links
+  for xref, tag, _, fields in records(lines):
+    if tag != 'INDI' or xref not in hashes:
+      continue
+    father, mother = parents.get(xref, ('', ''))
+    wedding_day, wedding_place = weddings.get(xref, ('', ''))
+    relative = empty_relative(hashes[xref])
+    # GEDCOM files of ours don't carry the portraits
+    existing = repository.get(hashes[xref])
+    if existing is not None:
+      relative['image'] = existing['image']
+    relative.update(name=import_name(first(fields, 'NAME')),
+                    sex=SEXES.get(first(fields, 'SEX').strip().upper(), ''),
+                    father=hashes.get(father, ''),
+                    mother=hashes.get(mother, ''),
+                    spouse=[hashes[spouse] for spouse in spouses.get(xref, []) if spouse in hashes],
+                    birthday=import_date(first(fields, 'BIRT', 'DATE')),
+                    birthplace=first(fields, 'BIRT', 'PLAC'),
+                    weddingDay=wedding_day,
+                    weddingPlace=wedding_place,
+                    dayOfDeath=import_date(first(fields, 'DEAT', 'DATE')),
+                    placeOfDeath=first(fields, 'DEAT', 'PLAC'),
+                    profession=first(fields, 'OCCU'))
+    relative.body = '\n\n'.join(note for note in every(fields, 'NOTE') if not note.startswith('@'))
+    yield relative
+
+def import_gedcom(file):
+  # file has to be a seekable text file; returns the number of imported
+  # relatives and the hashes of the stale family trees
+  links = read_links(file)
+  file.seek(0)
+
+  imported = 0
+  def batches():
+    nonlocal imported
+    batch = []
+    for relative in read_relatives(file, links):
+      batch.append(relative)
+      imported += 1
+      if len(batch) == BATCH_SIZE:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  stale = repository.commit_batches(batches())
+  return imported, stale
+
+def line(level, tag, value='', xref=None):
+  prefix = f'{level} {xref} {tag}' if xref else f'{level} {tag}'
+  return f'{prefix} {value}\n' if value else f'{prefix}\n'
+
+def text_lines(level, tag, text):
+  # Multi-line text as CONT lines, overlong lines split with CONC
+  lines = []
+  for i, paragraph in enumerate(text.split('\n')):
+    pieces = [paragraph[start:start + LINE_LENGTH] for start in range(0, len(paragraph), LINE_LENGTH)] or ['']
+    lines.append(line(level, tag, pieces[0]) if i == 0 else line(level + 1, 'CONT', pieces[0]))
+    lines += [line(level + 1, 'CONC', piece) for piece in pieces[1:]]
+  return lines
+
+def event_lines(tag, date, place):
+  if not date and not place:
+    return []
+  return [line(1, tag)] + ([line(2, 'DATE', export_date(date))] if date else []) + ([line(2, 'PLAC', place)] if place else [])
+
+def export_lines(relatives):
+  yield line(0, 'HEAD')
+  yield line(1, 'SOUR', 'genealogy')
+  yield line(1, 'GEDC')
+  yield line(2, 'VERS', '5.5.1')
+  yield line(2, 'FORM', 'LINEAGE-LINKED')
+  yield line(1, 'CHAR', 'UTF-8')
+
+  by_hash = {relative['hash']: relative for relative in relatives}
+  xrefs = {hash: f'@I{i}@' for i, hash in enumerate(by_hash, 1)}
+
+  # Families are couples, with the husband first where the sexes are known
+  families = {}
+  def family(a, b):
+    if by_hash.get(a, {}).get('sex') == 'female' or by_hash.get(b, {}).get('sex') == 'male':
+      a, b = b, a
+    key = (a if a in xrefs else '', b if b in xrefs else '')
+    if key not in families:
+      families[key] = {'xref': f'@F{len(families) + 1}@', 'children': []}
+    return families[key]
+
+  for relative in relatives:
+    if relative['father'] in xrefs or relative['mother'] in xrefs:
+      family(relative['father'], relative['mother'])['children'].append(relative['hash'])
+    for spouse in relative['spouse']:
+      if spouse in xrefs:
+        family(relative['hash'], spouse)
+
+  child_of = {}
+  spouse_in = {}
+  for (husband, wife), members in families.items():
+    for child in members['children']:
+      child_of.setdefault(child, members['xref'])
+    for partner in (husband, wife):
+      if partner:
+        spouse_in.setdefault(partner, []).append(members['xref'])
+
+  for relative in relatives:
+    hash = relative['hash']
+    yield line(0, 'INDI', xref=xrefs[hash])
+    name = relative['name'].rsplit(' ', 1)
+    yield line(1, 'NAME', f'{name[0]} /{name[1]}/' if len(name) == 2 else relative['name'])
+    if relative['sex'] in ('male', 'female'):
+      yield line(1, 'SEX', relative['sex'][0].upper())
+    yield from event_lines('BIRT', relative['birthday'], relative['birthplace'])
+    yield from event_lines('DEAT', relative['dayOfDeath'], relative['placeOfDeath'])
+    if relative['profession']:
+      yield line(1, 'OCCU', relative['profession'])
+    yield line(1, 'REFN', hash)
+    yield line(2, 'TYPE', REFN_TYPE)
+    body = relative.load_body()
+    if body.strip():
+      yield from text_lines(1, 'NOTE', body.strip())
+    if hash in child_of:
+      yield line(1, 'FAMC', child_of[hash])
+    for xref in spouse_in.get(hash, []):
+      yield line(1, 'FAMS', xref)
+
+  for (husband, wife), members in families.items():
+    yield line(0, 'FAM', xref=members['xref'])
+    if husband:
+      yield line(1, 'HUSB', xrefs[husband])
+    if wife:
+      yield line(1, 'WIFE', xrefs[wife])
+    if husband and wife:
+      partner = by_hash[husband] if by_hash[husband]['weddingDay'] or by_hash[husband]['weddingPlace'] else by_hash[wife]
+      yield from event_lines('MARR', partner['weddingDay'], partner['weddingPlace'])
+    for child in members['children']:
+      yield line(1, 'CHIL', xrefs[child])
+  yield line(0, 'TRLR')
+
+def export_gedcom():
+  # The whole archive in chunks of about CHUNK_SIZE characters
+  chunk = []
+  size = 0
+  for text in export_lines(repository.sorted(False)):
+    chunk.append(text)
+    size += len(text)
+    if size >= CHUNK_SIZE:
+      yield ''.join(chunk)
+      chunk = []
+      size = 0
+  yield ''.join(chunk)
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3 or sys.argv[1] not in ('import', 'export'):
+    sys.exit('usage: python3 -m genealogy.gedcom import|export <file.ged>')
+  if sys.argv[1] == 'import':
+    with open(sys.argv[2], 'r', encoding='utf-8-sig', errors='replace') as file:
+      imported, _ = import_gedcom(file)
+    print(f'{imported} relatives imported')
+  else:
+    with open(sys.argv[2], 'w', encoding='utf-8') as file:
+      for chunk in export_gedcom():
+        file.write(chunk)
@@ -1,13 +1,35 @@
+import base64
+import hashlib
+import mimetypes
 import os
+import shutil
 import subprocess
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-from genealogy.relatives import read_relative
+from genealogy import dir, svg
+from genealogy.metrics import count, span
+from genealogy.relatives import empty_relative, get_chart, get_relative
 
+try:
+  import cairosvg
+except ImportError:
+  cairosvg = None
 
-def generateTexNode(relative, x, y):
+
+TEX_DIR = 'data/tex/'
+IMAGE_DIR = 'data/relatives/images/'
+FAMILY_DIR = 'data/relatives/images/family/'
+
+# pdftoppm's default resolution, so that both backends give the same size
+TREE_DPI = 150
+
+
+def generateTexNode(relative, x, y, id=None):
   template = r'''\node[draw=<[color]>!70!white, fill=white, line width=0.1cm, minimum width=4cm, minimum height=9cm, path picture={
 \node [draw=<[color]>!10!white, fill=<[color]>!10!white, rounded corners=0, text width=3.6cm, inner sep=0.2cm, minimum width=4cm, minimum height=3cm, anchor=north] at (0cm,-1.5cm) {\begin{dynminipage}<[name]><[born]><[married]><[died]><[profession]>\end{dynminipage}};
-\fill [fill overzoom image={../relatives/images/<[image]>}, rounded corners=0] (-2cm,-1.5cm) rectangle (2cm,4.5cm);
+\fill [fill overzoom image={<[imagedir]>/<[image]>}, rounded corners=0] (-2cm,-1.5cm) rectangle (2cm,4.5cm);
 }, rectangle, rounded corners=0.2cm] (<[id]>) at <[pos]> {};
 '''
 
@@ -18,9 +40,10 @@ def generateTexNode(relative, x, y):
     color = 'red'
   template = template.replace('<[color]>', color)
 
-  template = template.replace('<[id]>',    f'id-{relative["hash"]}')
+  template = template.replace('<[id]>',    f'id-{id or relative["hash"]}')
   template = template.replace('<[pos]>',   f'({x}cm, {y}cm)')
   template = template.replace('<[name]>',  r'\textbf{' + relative['name'] + r'}')
+  template = template.replace('<[imagedir]>', os.path.abspath(IMAGE_DIR))
   template = template.replace('<[image]>', relative['image'])
 
   born = ''
@@ -56,76 +79,166 @@ def generateTexNode(relative, x, y):
 
   return template
 
-def generate_tree(relative_hash):
+def chart_relatives(chart):
   relatives = {}
+  for node in chart.nodes:
+    if node['hash'] not in relatives:
+      relatives[node['hash']] = get_relative(node['hash']) or empty_relative(node['hash'])
+  return relatives
 
-  # import all data
-  for root, _, files in os.walk('data/relatives/', topdown=False):
-    for name in files:
-      if name.endswith('.md'):
-        try:
-          relative = read_relative(os.path.join(root, name))
-        except:
-          pass
-        else:
-          relatives[relative['hash']] = relative
+def generate_tex(relative_hash, up=1, down=1):
+  chart = get_chart(relative_hash, up, down)
+  relatives = chart_relatives(chart)
 
-
-  ego = relatives[relative_hash]
-  children = [p['hash'] for p in relatives.values() if p['father'] == relative_hash or p['mother'] == relative_hash]
-
-  # get parents
-  NODES = ''
-  HUBS = ''
+  NODES = ''.join(generateTexNode(relatives[node['hash']], node['x'], node['y'], node['id']) for node in chart.nodes)
+  HUBS = ''.join(f'\\coordinate (hub-{hub["id"]}) at ({hub["x"]}cm, {hub["y"]}cm);' for hub in chart.hubs)
   CONNECTIONS = ''
+  for color, width in [('white', 0.4), ('black', 0.2)]:
+    for node_id, hub_id in chart.links:
+      CONNECTIONS += f'\\draw[line width={width}cm, {color}] (id-{node_id})|-(hub-{hub_id});'
 
-  if ego['father']:
-    NODES += generateTexNode(relatives[ego['father']], 5, 26)
-  if ego['mother']:
-    NODES += generateTexNode(relatives[ego['mother']], 10, 26)
-  NODES += generateTexNode(ego, 7.5, 13)
-  i = 0
-  for p in ego['spouse']:
-    NODES += generateTexNode(relatives[p], 12.5 + i*5, 13)
-    i += 1
-  i = 0
-  for p in children:
-    NODES += generateTexNode(relatives[p], 10 + i*5, 0)
-    i += 1
-    hub = f'hub-{relatives[p]["father"]}-{relatives[p]["mother"]}'
-    CONNECTIONS += r'\draw[line width=0.4cm, white] (id-' + p + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.2cm, black] (id-' + p + r')|-(' + hub + ');'
-
-  i = 0
-  for p in ego['spouse']:
-    hub = f'hub-{relative_hash}-{p}'
-    HUBS += f'\\coordinate ({hub}) at ({10+i*5}cm, {6.5+0.5*i}cm);'
-    hub = f'hub-{p}-{relative_hash}'
-    HUBS += f'\\coordinate ({hub}) at ({10+i*5}cm, {6.5+0.5*i}cm);'
-    CONNECTIONS += r'\draw[line width=0.4cm, white] (id-' + relative_hash + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.4cm, white] (id-' + p + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.2cm, black] (id-' + relative_hash + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.2cm, black] (id-' + p + r')|-(' + hub + ');'
-    i += 1
-  if ego['father'] and ego['mother']:
-    hub = f'hub-{ego["father"]}-{ego["mother"]}'
-    HUBS += f'\\coordinate ({hub}) at (7.5cm, 19.5cm);'
-    CONNECTIONS += r'\draw[line width=0.4cm, white] (id-' + ego['father'] + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.4cm, white] (id-' + ego['mother'] + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.4cm, white] (id-' + relative_hash + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.2cm, black] (id-' + ego['father'] + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.2cm, black] (id-' + ego['mother'] + r')|-(' + hub + ');'
-    CONNECTIONS += r'\draw[line width=0.2cm, black] (id-' + relative_hash + r')|-(' + hub + ');'
-
-  with open('data/tex/template-family.tex', 'r') as templatefile:
+  with open(os.path.join(TEX_DIR, 'template-family.tex'), 'r') as templatefile:
     template = templatefile.read()
 
-  with open(f"data/tex/{relative_hash}.tex", 'w') as writefile:
-    template = template.replace('%<<DEFINE-NODES>>', NODES)
-    template = template.replace('%<<DEFINE-HUBS>>', HUBS)
-    template = template.replace('%<<DEFINE-CONNECTIONS>>', CONNECTIONS)
-    writefile.write(template)
+  template = template.replace('%<<DEFINE-NODES>>', NODES)
+  template = template.replace('%<<DEFINE-HUBS>>', HUBS)
+  template = template.replace('%<<DEFINE-CONNECTIONS>>', CONNECTIONS)
+  return template
 
-  subprocess.call(['/usr/bin/pdflatex', f'{relative_hash}.tex'], cwd='data/tex/')
-  subprocess.call(['/usr/bin/pdftoppm', f'{relative_hash}.pdf', f'{relative_hash}', '-png'], cwd='data/tex/')
-  subprocess.call(['/usr/bin/mv', f'{relative_hash}-1.png', f'../relatives/images/family/{relative_hash}.png'], cwd='data/tex/')
+def generate_svg(relative_hash, image_url, up=1, down=1):
+  chart = get_chart(relative_hash, up, down)
+  return svg.render_svg(chart, chart_relatives(chart), image_url)
+
+def image_data_uri(image):
+  # Trees rendered without the web server embed their portraits
+  path = os.path.join(IMAGE_DIR, image)
+  try:
+    with open(path, 'rb') as f:
+      data = f.read()
+  except OSError:
+    return ''
+  mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+  return f'data:{mimetype};base64,' + base64.b64encode(data).decode('ascii')
+
+def generate_tree_svg(relative_hash):
+  images = {}
+  def image_url(image):
+    if image not in images:
+      images[image] = image_data_uri(image)
+    return images[image]
+  return generate_svg(relative_hash, image_url)
+
+def fingerprint(tex):
+  # The TeX source already contains template-family.tex and all the data
+  # shown in the tree; the portraits are only referenced by name
+  digest = hashlib.sha256(tex.encode('utf-8'))
+  images = sorted(set(re.findall(r'fill overzoom image=\{([^}]*)\}', tex)))
+  for image in images:
+    try:
+      with open(image, 'rb') as f:
+        digest.update(image.encode('utf-8') + b'\0' + hashlib.sha256(f.read()).digest())
+    except OSError:
+      digest.update(image.encode('utf-8') + b'\0missing')
+  return digest.hexdigest()
+
+def read_fingerprint(relative_hash):
+  if not os.path.exists(os.path.join(FAMILY_DIR, f'{relative_hash}.png')):
+    return None
+  try:
+    with open(os.path.join(TEX_DIR, f'{relative_hash}.fingerprint'), 'r') as f:
+      return f.read().strip()
+  except OSError:
+    return None
+
+def write_fingerprint(relative_hash, value):
+  dir.createDirIfNeeded(TEX_DIR)
+  with open(os.path.join(TEX_DIR, f'{relative_hash}.fingerprint'), 'w') as f:
+    f.write(value)
+
+def remove_fingerprint(relative_hash):
+  # The tree is rendered again even if its inputs are unchanged
+  try:
+    os.remove(os.path.join(TEX_DIR, f'{relative_hash}.fingerprint'))
+  except OSError:
+    pass
+
+def render_tex(relative_hash, tex, timeout=None):
+  # Every job gets its own working directory, so that concurrent pdflatex
+  # runs don't overwrite each other's aux and log files
+  dir.createDirIfNeeded(FAMILY_DIR)
+  workdir = tempfile.mkdtemp(prefix=f'{relative_hash}-', dir=TEX_DIR)
+  env = dict(os.environ, TEXINPUTS=os.path.abspath(TEX_DIR) + os.pathsep)
+  try:
+    with open(os.path.join(workdir, f'{relative_hash}.tex'), 'w') as writefile:
+      writefile.write(tex)
+    shutil.copy(os.path.join(workdir, f'{relative_hash}.tex'), TEX_DIR)
+
+    try:
+      count('subprocess_runs')
+      with span('pdflatex'):
+        subprocess.run(['/usr/bin/pdflatex', '-interaction=nonstopmode', f'{relative_hash}.tex'], cwd=workdir, env=env,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, timeout=timeout)
+    finally:
+      if os.path.exists(os.path.join(workdir, f'{relative_hash}.log')):
+        shutil.copy(os.path.join(workdir, f'{relative_hash}.log'), TEX_DIR)
+    if not os.path.exists(os.path.join(workdir, f'{relative_hash}.pdf')):
+      raise RuntimeError(f'pdflatex failed, see {TEX_DIR}{relative_hash}.log')
+    shutil.copy(os.path.join(workdir, f'{relative_hash}.pdf'), TEX_DIR)
+
+    count('subprocess_runs')
+    with span('pdftoppm'):
+      subprocess.run(['/usr/bin/pdftoppm', f'{relative_hash}.pdf', f'{relative_hash}', '-png', '-singlefile'], cwd=workdir,
+                     stdin=subprocess.DEVNULL, timeout=timeout, check=True)
+    shutil.move(os.path.join(workdir, f'{relative_hash}.png'), os.path.join(FAMILY_DIR, f'{relative_hash}.png'))
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+def svg_fingerprint(source):
+  # Portraits are embedded, so the source covers everything in the tree
+  return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+def render_svg(relative_hash, source, timeout=None):
+  if cairosvg is None:
+    raise RuntimeError('the svg tree backend needs cairosvg')
+  path = os.path.join(FAMILY_DIR, relative_hash)
+  with span('rasterise'), dir.replaceFile(f'{path}.png', 'wb') as f:
+    cairosvg.svg2png(bytestring=source.encode('utf-8'), write_to=f, dpi=TREE_DPI)
+
+  with dir.replaceFile(f'{path}.svg') as f:
+    f.write(source)
+
+# Each backend turns a relative into its source and its source into
+# FAMILY_DIR/<hash>.png; tex also leaves a print quality PDF in TEX_DIR
+BACKENDS = {
+  'tex': (generate_tex, fingerprint, render_tex),
+  'svg': (generate_tree_svg, svg_fingerprint, render_svg),
+}
+
+def generate_tree(relative_hash, timeout=None, force=False, backend='tex'):
+  generate, digest, render = BACKENDS[backend]
+  with span(backend):
+    source = generate(relative_hash)
+  value = digest(source)
+  if not force and read_fingerprint(relative_hash) == value:
+    return False
+
+  render(relative_hash, source, timeout)
+  write_fingerprint(relative_hash, value)
+  return True
+
+def generate_trees(hashes, workers=None, timeout=None, force=False, backend='tex'):
+  summary = {'succeeded': [], 'cached': [], 'failed': {}}
+  hashes = list(dict.fromkeys(hash for hash in hashes if hash))
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    jobs = {hash: executor.submit(generate_tree, hash, timeout, force, backend) for hash in hashes}
+    for hash, job in jobs.items():
+      try:
+        rendered = job.result()
+      except subprocess.TimeoutExpired:
+        summary['failed'][hash] = f'timed out after {timeout}s'
+      except Exception as e:
+        summary['failed'][hash] = f'{type(e).__name__}: {e}'
+      else:
+        summary['succeeded' if rendered else 'cached'].append(hash)
+  return summary
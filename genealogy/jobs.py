@@ -0,0 +1,140 @@
+import os
+import time
+from datetime import datetime
+
+from genealogy import app, dir
+from genealogy.graph import IMAGE_DIR, generate_trees, remove_fingerprint
+from genealogy.metrics import metrics
+from genealogy.relatives import file_stamp, get_portraits, get_trees_using_images
+
+
+# Spool directory shared by all uWSGI processes. A job is a file named after
+# the hash of the tree to render; it moves from pending/ to running/ and ends
+# up in done/ or failed/.
+JOBS_DIR = 'data/jobs/'
+STATES = ['pending', 'running', 'done', 'failed']
+POLL_INTERVAL = 1.0
+
+# Portraits are replaced directly in IMAGE_DIR, the worker looks for changed
+# ones at this interval and renders the trees showing them again
+PORTRAIT_INTERVAL = 30.0
+
+
+def job_file(state, hash):
+  return os.path.join(JOBS_DIR, state, hash)
+
+def submit_trees(hashes, force=False):
+  dir.createDirIfNeeded(os.path.join(JOBS_DIR, 'pending'))
+  submitted = []
+  for hash in dict.fromkeys(hashes):
+    if not hash:
+      continue
+    if force:
+      remove_fingerprint(hash)
+    try:
+      # A pending job for the same hash already covers this request
+      fd = os.open(job_file('pending', hash), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+      continue
+    with os.fdopen(fd, 'w') as file:
+      file.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    submitted.append(hash)
+  return submitted
+
+def job_status():
+  status = {}
+  for state in STATES:
+    path = os.path.join(JOBS_DIR, state)
+    status[state] = {}
+    if not os.path.isdir(path):
+      continue
+    for hash in sorted(os.listdir(path)):
+      try:
+        with open(os.path.join(path, hash), 'r') as file:
+          status[state][hash] = file.read()
+      except OSError:
+        pass
+  return status
+
+def submitted_at(entry):
+  try:
+    return entry.stat().st_mtime
+  except OSError:
+    return 0
+
+def claim_jobs(limit):
+  try:
+    pending = sorted(os.scandir(os.path.join(JOBS_DIR, 'pending')), key=submitted_at)
+  except OSError:
+    return []
+
+  claimed = []
+  for entry in pending[:limit]:
+    try:
+      os.rename(entry.path, job_file('running', entry.name))
+    except OSError:
+      continue # claimed by another worker
+    claimed.append(entry.name)
+  return claimed
+
+def finish_job(hash, state, message):
+  with open(job_file(state, hash), 'w') as file:
+    file.write(message)
+  for other in ['done', 'failed']:
+    if other != state and os.path.exists(job_file(other, hash)):
+      os.remove(job_file(other, hash))
+  os.remove(job_file('running', hash))
+
+def recover_jobs():
+  for state in STATES:
+    dir.createDirIfNeeded(os.path.join(JOBS_DIR, state))
+
+  # Jobs left in running/ belong to a worker that died
+  path = os.path.join(JOBS_DIR, 'running')
+  for hash in os.listdir(path):
+    if os.path.exists(job_file('pending', hash)):
+      os.remove(os.path.join(path, hash))
+    else:
+      os.rename(os.path.join(path, hash), job_file('pending', hash))
+
+def changed_portraits(stamps):
+  # stamps maps the portraits to their stamps when this was called last
+  changed = []
+  for image in get_portraits():
+    stamp = file_stamp(os.path.join(IMAGE_DIR, image))
+    if image in stamps and stamps[image] != stamp:
+      changed.append(image)
+    stamps[image] = stamp
+  return changed
+
+def run_worker():
+  recover_jobs()
+
+  workers = app.config['TREE_WORKERS']
+  stamps = {}
+  checked = None
+  while True:
+    if checked is None or time.monotonic() - checked >= PORTRAIT_INTERVAL:
+      checked = time.monotonic()
+      submit_trees(get_trees_using_images(changed_portraits(stamps)))
+
+    hashes = claim_jobs(workers)
+    if not hashes:
+      # The rendering timings of this process only show in /metrics once
+      # they are spooled
+      metrics.write_spool()
+      time.sleep(POLL_INTERVAL)
+      continue
+
+    summary = generate_trees(hashes, workers, app.config['TREE_TIMEOUT'], backend=app.config['TREE_BACKEND'])
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for hash in summary['succeeded']:
+      finish_job(hash, 'done', f'{timestamp} rendered')
+    for hash in summary['cached']:
+      finish_job(hash, 'done', f'{timestamp} unchanged')
+    for hash, reason in summary['failed'].items():
+      finish_job(hash, 'failed', f'{timestamp} {reason}')
+    metrics.write_spool(force=True)
+
+if __name__ == '__main__':
+  run_worker()
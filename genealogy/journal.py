@@ -0,0 +1,88 @@
+import json
+import os
+import uuid
+
+# Writes several files as one transaction: the new contents go to temporary
+# files next to their targets, then a journal listing the renames and
+# removals is committed by renaming it into place, then the journal is
+# applied. After a crash, recover() finishes a committed transaction and
+# drops an uncommitted one. The caller has to hold the lock of the
+# directory, so that only one transaction runs at a time.
+
+JOURNAL = '.journal'
+TMP_MARKER = '.tmp-'
+
+
+def journal_file(path):
+  return os.path.join(path, JOURNAL)
+
+def fsync_dir(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def write_file(filename, text, fsync=True):
+  with open(filename, 'w') as file:
+    file.write(text)
+    if fsync:
+      file.flush()
+      os.fsync(file.fileno())
+
+def remove_file(filename):
+  try:
+    os.remove(filename)
+  except FileNotFoundError:
+    pass
+
+def commit(path, writes, removes=(), fsync=True):
+  # writes maps filenames to their new text, removes lists filenames to
+  # delete; returns all filenames that changed. Without fsync, large
+  # batches are flushed with one sync instead of one fsync per file.
+  id = uuid.uuid4().hex
+  replace = []
+  try:
+    for filename, text in writes.items():
+      tmp = f'{filename}{TMP_MARKER}{id}'
+      replace.append((tmp, filename))
+      write_file(tmp, text, fsync)
+    if not fsync:
+      os.sync()
+    write_file(journal_file(path) + TMP_MARKER + id, json.dumps({'replace': replace, 'remove': list(removes)}))
+  except BaseException:
+    for tmp, _ in replace:
+      remove_file(tmp)
+    remove_file(journal_file(path) + TMP_MARKER + id)
+    raise
+
+  os.replace(journal_file(path) + TMP_MARKER + id, journal_file(path))
+  fsync_dir(path)
+  return apply(path)
+
+def apply(path):
+  # Idempotent, so it can be repeated after a crash while applying
+  with open(journal_file(path), 'r') as file:
+    journal = json.load(file)
+
+  targets = {filename for _, filename in journal['replace']}
+  for tmp, filename in journal['replace']:
+    if os.path.exists(tmp):
+      os.replace(tmp, filename)
+  for filename in journal['remove']:
+    if filename not in targets:
+      remove_file(filename)
+
+  for directory in {os.path.dirname(filename) or '.' for filename in targets | set(journal['remove'])}:
+    fsync_dir(directory)
+  os.remove(journal_file(path))
+  fsync_dir(path)
+  return sorted(targets | set(journal['remove']))
+
+def recover(path):
+  # Returns the filenames changed by finishing a committed transaction.
+  # Temporary files of a transaction that never committed don't end in .md
+  # and are ignored.
+  if os.path.exists(journal_file(path)):
+    return apply(path)
+  return []
@@ -0,0 +1,61 @@
+class KinshipIndex:
+  def __init__(self):
+    self.parents = {}  # hash -> (father, mother)
+    self.children = {} # parent hash -> set of child hashes
+    self.couples = {}  # (father, mother) -> set of child hashes
+    self.spouses = {}  # hash -> set of hashes listing it as spouse
+    self.partners = {} # hash -> spouses listed by it
+
+  def add(self, relative):
+    hash = relative['hash']
+    father = relative.get('father', '')
+    mother = relative.get('mother', '')
+
+    self.parents[hash] = (father, mother)
+    for parent in (father, mother):
+      if parent:
+        self.children.setdefault(parent, set()).add(hash)
+    if father or mother:
+      self.couples.setdefault((father, mother), set()).add(hash)
+    self.partners[hash] = tuple(spouse for spouse in relative.get('spouse', []) if spouse)
+    for spouse in self.partners[hash]:
+      self.spouses.setdefault(spouse, set()).add(hash)
+
+  def remove(self, relative):
+    hash = relative['hash']
+    father, mother = self.parents.pop(hash, ('', ''))
+    self.partners.pop(hash, None)
+
+    for parent in (father, mother):
+      _discard(self.children, parent, hash)
+    _discard(self.couples, (father, mother), hash)
+    for spouse in relative.get('spouse', []):
+      _discard(self.spouses, spouse, hash)
+
+  def children_of(self, hash):
+    return set(self.children.get(hash, ()))
+
+  def children_of_couple(self, father, mother):
+    return set(self.couples.get((father, mother), ()))
+
+  def siblings_of(self, hash):
+    siblings = set()
+    for parent in self.parents.get(hash, ('', '')):
+      if parent:
+        siblings |= self.children.get(parent, set())
+    siblings.discard(hash)
+    return siblings
+
+  def spouse_of(self, hash):
+    return set(self.spouses.get(hash, ()))
+
+  def partners_of(self, hash):
+    return set(self.partners.get(hash, ())) | self.spouses.get(hash, set())
+
+def _discard(index, key, hash):
+  values = index.get(key)
+  if values is None:
+    return
+  values.discard(hash)
+  if not values:
+    del index[key]
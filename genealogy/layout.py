@@ -0,0 +1,123 @@
+# Layout of multi-generation charts. Every subtree gets a contiguous range
+# of slots on the x axis; a person is placed between the people it's drawn
+# under or above, and siblings' ranges never overlap, so no two cards of a
+# generation collide. Coordinates are in cm, with y pointing up like TikZ.
+
+CARD_WIDTH = 4.0
+CARD_HEIGHT = 9.0
+SLOT = 5.0        # horizontal distance between cards
+ROW = 13.0        # vertical distance between generations
+HUB_OFFSET = 0.5  # vertical offset between hubs of the same person
+
+# People are drawn once per path to them, so charts grow exponentially with
+# pedigree collapse
+MAX_GENERATIONS = 8
+
+
+class Chart:
+  def __init__(self):
+    self.nodes = []  # {'id', 'hash', 'x', 'y'}
+    self.hubs = []   # {'id', 'x', 'y'}
+    self.links = []  # (node id, hub id)
+
+  def add_node(self, hash, x, y):
+    node = {'id': f'n{len(self.nodes)}', 'hash': hash, 'x': x, 'y': y}
+    self.nodes.append(node)
+    return node
+
+  def add_hub(self, x, y, members):
+    hub = {'id': f'h{len(self.hubs)}', 'x': x, 'y': y}
+    self.hubs.append(hub)
+    for member in members:
+      self.links.append((member['id'], hub['id']))
+    return hub
+
+  def shift(self, dx):
+    for item in self.nodes + self.hubs:
+      item['x'] += dx
+
+  def bounds(self):
+    xs = [node['x'] for node in self.nodes]
+    ys = [node['y'] for node in self.nodes]
+    return (min(xs) - CARD_WIDTH / 2, min(ys) - CARD_HEIGHT / 2,
+            max(xs) + CARD_WIDTH / 2, max(ys) + CARD_HEIGHT / 2)
+
+class Slots:
+  def __init__(self):
+    self.next = 0
+
+  def take(self, count=1):
+    first = self.next
+    self.next += count
+    return first
+
+def layout_ancestors(kinship, chart, hash, generations, slots, level=0):
+  # Returns the node of hash and the range of slots used by its subtree
+  parents = [parent for parent in kinship.parents.get(hash, ('', '')) if parent] if level < generations else []
+  if not parents:
+    slot = slots.take()
+    return chart.add_node(hash, slot * SLOT, level * ROW), (slot, slot)
+
+  placed = [layout_ancestors(kinship, chart, parent, generations, slots, level + 1) for parent in parents]
+  x = sum(node['x'] for node, _ in placed) / len(placed)
+  node = chart.add_node(hash, x, level * ROW)
+  chart.add_hub(x, level * ROW + ROW / 2, [node] + [parent for parent, _ in placed])
+  return node, (placed[0][1][0], placed[-1][1][1])
+
+def layout_descendants(kinship, chart, hash, generations, slots, order, level=0):
+  # A person is drawn together with their spouses, in the order of their
+  # spouse field, and their children below them; the last generation is
+  # drawn without spouses
+  spouses = list(kinship.partners.get(hash, ())) if level < generations else []
+  width = 1 + len(spouses)
+  children = order(kinship.children_of(hash)) if level < generations else []
+
+  if not children:
+    first = slots.take(width)
+    last = first + width - 1
+    x = first * SLOT
+  else:
+    placed = [layout_descendants(kinship, chart, child, generations, slots, order, level + 1) for child in children]
+    first, last = placed[0][1][0], placed[-1][1][1]
+    if last - first + 1 < width:
+      last = first + width - 1
+      slots.next = max(slots.next, last + 1)
+    center = sum(node['x'] for node, _ in placed) / len(placed)
+    x = min(max(center - (width - 1) * SLOT / 2, first * SLOT), (last - width + 1) * SLOT)
+
+  y = -level * ROW
+  node = chart.add_node(hash, x, y)
+  partners = {spouse: chart.add_node(spouse, x + (i + 1) * SLOT, y) for i, spouse in enumerate(spouses)}
+
+  if children:
+    hubs = {}
+    for child, _ in placed:
+      father, mother = kinship.parents.get(child['hash'], ('', ''))
+      other = mother if father == hash else father
+      if other not in hubs:
+        members = [node] + ([partners[other]] if other in partners else [])
+        hub_x = sum(member['x'] for member in members) / len(members)
+        hubs[other] = chart.add_hub(hub_x, y - ROW / 2 + len(hubs) * HUB_OFFSET, members)
+      chart.links.append((child['id'], hubs[other]['id']))
+  return node, (first, last)
+
+def layout_chart(kinship, hash, up, down, order=sorted):
+  # order sorts a collection of hashes into the left to right order
+  ancestors = Chart()
+  root, _ = layout_ancestors(kinship, ancestors, hash, up, Slots())
+
+  chart = Chart()
+  ego, _ = layout_descendants(kinship, chart, hash, down, Slots(), order)
+  chart.shift(root['x'] - ego['x'])
+
+  # The root is already part of the descendants' chart
+  ids = {root['id']: ego['id']}
+  for node in ancestors.nodes:
+    if node is not root:
+      ids[node['id']] = chart.add_node(node['hash'], node['x'], node['y'])['id']
+  for hub in ancestors.hubs:
+    new = chart.add_hub(hub['x'], hub['y'], [])
+    ids[hub['id']] = new['id']
+  for node_id, hub_id in ancestors.links:
+    chart.links.append((ids[node_id], ids[hub_id]))
+  return chart
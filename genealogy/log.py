@@ -0,0 +1,68 @@
+import atexit
+import os
+import threading
+from datetime import datetime
+
+from genealogy import dir
+
+
+LOG_DIR = 'data/log/'
+LOG_FILE = 'requests.md'
+FLUSH_INTERVAL = 1.0     # seconds
+FLUSH_SIZE = 500         # entries that trigger an early flush
+MAX_SIZE = 10 * 2**20    # bytes before the log file is rotated
+
+
+class RequestLog:
+  # Collects log lines in memory; a background thread of each worker process
+  # appends them to the log file in batches
+  def __init__(self, path, filename):
+    self.path = path
+    self.filename = filename
+    self._entries = []
+    self._condition = threading.Condition()
+    self._pid = None
+
+  def log(self, line):
+    with self._condition:
+      self._entries.append(line)
+      if self._pid != os.getpid():
+        # uWSGI forks the workers after the app is loaded, so every process
+        # needs its own thread
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+      if len(self._entries) >= FLUSH_SIZE:
+        self._condition.notify()
+
+  def _run(self):
+    while True:
+      with self._condition:
+        self._condition.wait(FLUSH_INTERVAL)
+      self.flush()
+
+  def flush(self):
+    with self._condition:
+      entries, self._entries = self._entries, []
+    if not entries:
+      return
+
+    try:
+      dir.createDirIfNeeded(self.path)
+      filename = os.path.join(self.path, self.filename)
+      self._rotate(filename)
+      with open(filename, 'a') as file:
+        file.write(''.join(entries))
+    except OSError:
+      pass
+
+  def _rotate(self, filename):
+    try:
+      if os.path.getsize(filename) < MAX_SIZE:
+        return
+      name, ext = os.path.splitext(filename)
+      os.rename(filename, f'{name}-{datetime.now().strftime("%Y%m%d-%H%M%S")}{ext}')
+    except OSError:
+      pass # missing, or rotated by another worker
+
+request_log = RequestLog(LOG_DIR, LOG_FILE)
+atexit.register(request_log.flush)
@@ -0,0 +1,143 @@
+import math
+import os
+import pickle
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+from genealogy import dir
+
+# Number of recent samples per series used for the percentiles
+SAMPLES = 1024
+QUANTILES = [0.5, 0.9, 0.99]
+
+# Every worker process writes its metrics to SPOOL_DIR/<pid>.metrics at most
+# every SPOOL_INTERVAL seconds, /metrics shows those of all workers
+SPOOL_DIR = 'data/metrics/'
+SPOOL_INTERVAL = 5.0
+
+
+def alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+class Metrics:
+  # Metrics of the current worker process
+  def __init__(self, spool):
+    self._lock = threading.Lock()
+    self.summaries = {} # (metric, label, value) -> [count, sum, recent samples]
+    self.counters = {}  # event -> total
+    self.spool = spool
+    self._spooled = None
+
+  def observe(self, metric, label, value, sample):
+    with self._lock:
+      key = (metric, label, value)
+      if key not in self.summaries:
+        self.summaries[key] = [0, 0.0, deque(maxlen=SAMPLES)]
+      summary = self.summaries[key]
+      summary[0] += 1
+      summary[1] += sample
+      summary[2].append(sample)
+
+  def count(self, event, n=1):
+    with self._lock:
+      self.counters[event] = self.counters.get(event, 0) + n
+    if has_request_context():
+      counts = g.setdefault('metrics_counts', {})
+      counts[event] = counts.get(event, 0) + n
+
+  def finish_request(self, endpoint, seconds):
+    self.observe('genealogy_request_seconds', 'endpoint', endpoint, seconds)
+    counts = g.get('metrics_counts', {})
+    for event in list(self.counters):
+      self.observe('genealogy_request_events', 'event', event, counts.get(event, 0))
+    self.write_spool()
+
+  def snapshot(self):
+    # Summaries as count, sum and quantiles
+    with self._lock:
+      summaries = {key: (count, total, sorted(samples)) for key, (count, total, samples) in self.summaries.items()}
+      counters = dict(self.counters)
+    for key, (count, total, samples) in summaries.items():
+      quantiles = [samples[max(0, math.ceil(quantile * len(samples)) - 1)] for quantile in QUANTILES]
+      summaries[key] = (count, total, quantiles)
+    return {'summaries': summaries, 'counters': counters}
+
+  def write_spool(self, force=False):
+    now = time.monotonic()
+    if not force and self._spooled is not None and now - self._spooled < SPOOL_INTERVAL:
+      return
+    self._spooled = now
+    filename = os.path.join(self.spool, f'{os.getpid()}.metrics')
+    try:
+      with dir.replaceFile(filename, 'wb') as file:
+        pickle.dump(self.snapshot(), file, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+      pass
+
+  def workers(self):
+    # pid -> snapshot of every live worker process, this one up to date
+    self.write_spool(force=True)
+    workers = {os.getpid(): self.snapshot()}
+    for entry in os.scandir(self.spool):
+      pid, _, extension = entry.name.partition('.')
+      if extension != 'metrics' or not pid.isdigit() or int(pid) in workers:
+        continue
+      if not alive(int(pid)):
+        try:
+          os.remove(entry.path)
+        except OSError:
+          pass
+        continue
+      try:
+        with open(entry.path, 'rb') as file:
+          workers[int(pid)] = pickle.load(file)
+      except:
+        continue
+    return workers
+
+  def render(self):
+    # Every worker's series with a worker label, as percentiles can't be
+    # merged and counters of restarted workers start from zero
+    workers = sorted(self.workers().items())
+
+    lines = []
+    names = sorted({key[0] for _, snapshot in workers for key in snapshot['summaries']})
+    for metric in names:
+      lines.append(f'# TYPE {metric} summary')
+      for pid, snapshot in workers:
+        for (name, label, value), (count, total, quantiles) in sorted(snapshot['summaries'].items()):
+          if name != metric:
+            continue
+          labels = f'worker="{pid}",{label}="{value}"'
+          for quantile, sample in zip(QUANTILES, quantiles):
+            lines.append(f'{metric}{{{labels},quantile="{quantile}"}} {sample:g}')
+          lines.append(f'{metric}_sum{{{labels}}} {total:g}')
+          lines.append(f'{metric}_count{{{labels}}} {count}')
+    lines.append('# TYPE genealogy_events_total counter')
+    for pid, snapshot in workers:
+      for event, total in sorted(snapshot['counters'].items()):
+        lines.append(f'genealogy_events_total{{worker="{pid}",event="{event}"}} {total}')
+    return '\n'.join(lines) + '\n'
+
+metrics = Metrics(SPOOL_DIR)
+
+@contextmanager
+def span(stage):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    metrics.observe('genealogy_stage_seconds', 'stage', stage, time.perf_counter() - start)
+
+def count(event, n=1):
+  metrics.count(event, n)
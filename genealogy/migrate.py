@@ -0,0 +1,53 @@
+import sys
+
+from genealogy.relatives import BATCH_SIZE, open_storage
+
+# Copies all relatives from one storage to the other, so that the target
+# holds the same records as the source afterwards:
+#   python3 -m genealogy.migrate markdown sqlite
+#   python3 -m genealogy.migrate sqlite markdown
+# Stop the application while migrating and switch app.config['STORAGE']
+# afterwards.
+
+
+def migrate(source, target):
+  # Returns the number of copied relatives and the keys of the source
+  # records that couldn't be read
+  hashes = set()
+  failed = []
+
+  def batches():
+    batch = []
+    for key, stamp in source.scan():
+      try:
+        relative, _ = source.load(key, stamp)
+      except Exception:
+        relative = None
+      if relative is None or not relative['hash']:
+        failed.append(key)
+        continue
+      hashes.add(relative['hash'])
+      batch.append(relative)
+      if len(batch) == BATCH_SIZE:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  with target.lock():
+    target.recover()
+    for batch in batches():
+      target.commit(batch, fsync=False)
+    removes = [key for key, _ in target.scan() if target.hash(key) not in hashes]
+    target.commit([], removes)
+    target.touch()
+  return len(hashes), failed
+
+if __name__ == '__main__':
+  names = sys.argv[1:]
+  if len(names) != 2 or names[0] == names[1] or not set(names) <= {'markdown', 'sqlite'}:
+    sys.exit('usage: python3 -m genealogy.migrate markdown|sqlite sqlite|markdown')
+  copied, failed = migrate(open_storage(names[0]), open_storage(names[1]))
+  for key in failed:
+    print(f'Failed to read {key}', file=sys.stderr)
+  print(f'{copied} relatives copied from {names[0]} to {names[1]}')
@@ -0,0 +1,125 @@
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import flask_login
+from flask import Response, g, make_response, request, session
+
+from genealogy import app, thumbnails
+from genealogy.metrics import count
+from genealogy.relatives import get_validator
+
+# Rendered pages of the read-only views, per worker process
+PAGE_CACHE_SIZE = 256
+
+
+def template_stamp():
+  # Deploying new templates must change the validators as well
+  digest = hashlib.sha256()
+  for root, _, files in sorted(os.walk(os.path.join(app.root_path, app.template_folder))):
+    for filename in sorted(files):
+      stat = os.stat(os.path.join(root, filename))
+      digest.update(f'{filename}\0{stat.st_mtime_ns}\0{stat.st_size}\n'.encode('utf-8'))
+  return digest.hexdigest()
+
+class PageCache:
+  def __init__(self, size):
+    self.size = size
+    self._pages = OrderedDict()
+    self._lock = threading.Lock()
+    self._templates = None
+
+  def templates(self):
+    if self._templates is None:
+      self._templates = template_stamp()
+    return self._templates
+
+  def get(self, key):
+    with self._lock:
+      page = self._pages.get(key)
+      if page is not None:
+        self._pages.move_to_end(key)
+      return page
+
+  def put(self, key, page):
+    with self._lock:
+      self._pages[key] = page
+      self._pages.move_to_end(key)
+      while len(self._pages) > self.size:
+        self._pages.popitem(last=False)
+
+page_cache = PageCache(PAGE_CACHE_SIZE)
+# The images each page linked to when it was rendered last
+page_images = PageCache(PAGE_CACHE_SIZE)
+
+def render_page(view, args, kwargs):
+  g.page_images = set()
+  try:
+    page = view(*args, **kwargs)
+  finally:
+    images = tuple(sorted(g.pop('page_images')))
+  return page, images
+
+def cached_page(view):
+  # Answers conditional requests with 304 and repeated ones from the cache,
+  # as long as no relative and none of the images the page links to
+  # changed. Pages show the name of the user and depend on their role, so
+  # both are part of the key.
+  @functools.wraps(view)
+  def wrapper(*args, **kwargs):
+    if request.method != 'GET' or session.get('_flashes'):
+      return view(*args, **kwargs)
+
+    validator, modified = get_validator()
+    user = flask_login.current_user
+    role = 'anonymous' if user.is_anonymous else user.role
+    base = (request.full_path, role, user.get_id(), validator, page_cache.templates())
+    page = None
+    images = page_images.get(base)
+    if images is None:
+      count('page_cache_misses')
+      page, images = render_page(view, args, kwargs)
+      if not isinstance(page, str):
+        return page
+      page_images.put(base, images)
+
+    # Thumbnail URLs carry the version of their image and are cached for good
+    stamps = tuple((image, thumbnails.stamp(image)) for image in images)
+    key = base + (stamps,)
+    if page is not None:
+      page_cache.put(key, page)
+    etag = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+    modified = max([modified] + [image_stamp[0] for _, image_stamp in stamps if image_stamp])
+    last_modified = datetime.fromtimestamp(modified // 10**9, timezone.utc)
+
+    if request.if_none_match:
+      not_modified = request.if_none_match.contains(etag)
+    else:
+      not_modified = request.if_modified_since is not None and request.if_modified_since >= last_modified
+    if not_modified:
+      count('pages_not_modified')
+      response = Response(status=304)
+    else:
+      if page is None:
+        page = page_cache.get(key)
+        if page is None:
+          count('page_cache_misses')
+          # Links to the same images as before, as the relatives didn't change
+          page = view(*args, **kwargs)
+          if not isinstance(page, str):
+            return page
+          page_cache.put(key, page)
+        else:
+          count('page_cache_hits')
+      response = make_response(page)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+  return wrapper
@@ -0,0 +1,81 @@
+from collections import deque
+
+
+MAX_GENERATIONS = 30
+
+
+def walk_generations(step, hash, generations):
+  # Breadth-first walk over one generation at a time. Returns a list with a
+  # {hash: number of paths} dict per generation; a person reached via more
+  # than one path indicates pedigree collapse.
+  result = []
+  frontier = {hash: 1}
+  for _ in range(min(generations, MAX_GENERATIONS)):
+    next_frontier = {}
+    for person, paths in frontier.items():
+      for relative in step(person):
+        if relative:
+          next_frontier[relative] = next_frontier.get(relative, 0) + paths
+    if not next_frontier:
+      break
+    result.append(next_frontier)
+    frontier = next_frontier
+  return result
+
+def ancestors(kinship, hash, generations):
+  return walk_generations(lambda person: kinship.parents.get(person, ()), hash, generations)
+
+def descendants(kinship, hash, generations):
+  return walk_generations(lambda person: kinship.children.get(person, ()), hash, generations)
+
+def pedigree_collapse(generations):
+  # Persons reached via more than one path: hash -> number of paths
+  paths = {}
+  for generation in generations:
+    for person, count in generation.items():
+      paths[person] = paths.get(person, 0) + count
+  return {person: count for person, count in paths.items() if count > 1}
+
+def distances(kinship, hash, generations=MAX_GENERATIONS):
+  result = {hash: 0}
+  for i, generation in enumerate(ancestors(kinship, hash, generations)):
+    for person in generation:
+      result.setdefault(person, i + 1)
+  return result
+
+def common_ancestors(kinship, a, b, generations=MAX_GENERATIONS):
+  # Returns (hash, generations above a, generations above b), closest first
+  distances_a = distances(kinship, a, generations)
+  distances_b = distances(kinship, b, generations)
+  common = [(person, distances_a[person], distances_b[person]) for person in distances_a if person in distances_b]
+  common.sort(key=lambda entry: (entry[1] + entry[2], entry[0]))
+  return common
+
+def relationship_path(kinship, a, b):
+  # Shortest path of (hash, relation) steps from a to b, where relation is
+  # how the hash relates to the previous step
+  if a == b:
+    return [(a, '')]
+
+  previous = {a: None}
+  queue = deque([a])
+  while queue:
+    person = queue.popleft()
+    father, mother = kinship.parents.get(person, ('', ''))
+    steps = [(father, 'father'), (mother, 'mother')]
+    steps += [(child, 'child') for child in sorted(kinship.children.get(person, ()))]
+    steps += [(spouse, 'spouse') for spouse in sorted(kinship.partners_of(person))]
+    for relative, relation in steps:
+      if not relative or relative in previous:
+        continue
+      previous[relative] = (person, relation)
+      if relative == b:
+        path = []
+        while previous[relative] is not None:
+          person, relation = previous[relative]
+          path.append((relative, relation))
+          relative = person
+        path.append((a, ''))
+        return path[::-1]
+      queue.append(relative)
+  return None
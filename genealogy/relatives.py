@@ -1,9 +1,63 @@
+import base64
+import bisect
+import fcntl
+import hashlib
 import json
 import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import markdown
 
-from genealogy import dir
+from genealogy import app, dir, journal, layout, pedigree
+from genealogy.dependencies import DependencyGraph, tree_signature
+from genealogy.kinship import KinshipIndex
+from genealogy.metrics import count, span
+from genealogy.search import SearchIndex, fold
+from genealogy.validation import Validator, check_edit
+
+
+DIR = 'data/relatives/'
+DATABASE = 'data/relatives.sqlite'
+
+# Full scans of the storage are throttled to this interval. Writes done
+# through write_relative bump the generation stamp, which makes every process
+# pick them up right away.
+RESCAN_INTERVAL = 30.0
+
+# All parsed front matter in a single file, so that starting a worker doesn't
+# depend on the number of .md files. Bodies are read on demand.
+SNAPSHOT_FILE = 'data/cache/relatives.snapshot'
+SNAPSHOT_VERSION = 1
+
+# Rewriting the snapshot of a large archive takes longer than a commit, so a
+# process writes it at most every SNAPSHOT_INTERVAL seconds. New workers
+# start from an outdated snapshot and scan for the records changed since.
+SNAPSHOT_INTERVAL = 60.0
+
+# The search index, with the stamps of the records it was built from. A
+# worker only indexes the records that changed since.
+SEARCH_FILE = 'data/cache/search.index'
+SEARCH_VERSION = 1
+
+# Rendered biographies are cached by the hash of their Markdown source. Set
+# HTML_CACHE_DIR to None to keep the cache in memory only. Edits leave the
+# renderings of old bodies behind, so beyond HTML_CACHE_FILES files the least
+# recently used ones are removed, checked every HTML_PRUNE_INTERVAL seconds.
+HTML_CACHE_DIR = 'data/cache/html/'
+HTML_CACHE_SIZE = 1024
+HTML_CACHE_FILES = 20000
+HTML_PRUNE_INTERVAL = 600.0
+
+# Relatives per page of the listing
+PAGE_SIZE = 60
+
+# Records per transaction of bulk writes
+BATCH_SIZE = 1000
 
 
 def read_relative(filename: str):
@@ -12,13 +66,14 @@ def read_relative(filename: str):
       text = f.read()
   except:
     return None
+  count('files_read')
 
-  data = text.split('---\n', maxsplit=2)
+  return parse_relative(text)
 
-  body = data[-1]
-  body_html = markdown.markdown(data[-1])
+def parse_relative(text):
+  data = text.split('---\n', maxsplit=2)
 
-  relative = {'body': body, 'body_html': body_html}
+  relative = Relative(body=data[-1])
 
   if len(data) == 3:
     meta = json.loads('{' + data[-2] + '}')
@@ -26,31 +81,734 @@ def read_relative(filename: str):
 
   return relative
 
+def load_relative(filename):
+  # Returns the relative and the byte offset of its body within the file,
+  # None if the body can't be read from an offset
+  with open(filename, 'rb') as f:
+    raw = f.read()
+  count('files_read')
+  text = raw.decode('utf-8')
+  if '\r' in text:
+    return parse_relative(text.replace('\r\n', '\n').replace('\r', '\n')), None
+  relative = parse_relative(text)
+  return relative, len(raw) - len(relative.body.encode('utf-8'))
+
+def read_body(filename, stamp, offset):
+  if offset is None or file_stamp(filename) != stamp:
+    relative = read_relative(filename)
+    return relative.body if relative else ''
+  count('files_read')
+  with open(filename, 'rb') as f:
+    f.seek(offset)
+    return f.read().decode('utf-8')
+
+FIELDS = ('hash', 'name', 'sex', 'father', 'mother', 'spouse', 'birthday', 'birthplace',
+          'weddingDay', 'weddingPlace', 'dayOfDeath', 'placeOfDeath', 'profession', 'image')
+
+# Values that repeat across many relatives share a single string object
+INTERNED = {'sex', 'father', 'mother', 'birthplace', 'weddingPlace', 'placeOfDeath', 'profession', 'image'}
+
+ATTRIBUTES = set(FIELDS) | {'body', 'body_html', 'children', 'siblings'}
+
+class Relative:
+  # Behaves like the dict it replaces, so templates and write_relative can
+  # use relative['name'] as well as relative.name. Unknown front matter keys
+  # end up in extra. The body is read from the storage on first access.
+  __slots__ = FIELDS + ('extra', 'children', 'siblings', '_body', '_source')
+
+  def __init__(self, meta=None, body=''):
+    for field in FIELDS:
+      setattr(self, field, '')
+    self.spouse = []
+    self.extra = None
+    self.children = []
+    self.siblings = []
+    self._body = body
+    self._source = None
+    if meta:
+      self.update(meta)
+
+  @property
+  def body(self):
+    if self._body is None:
+      self._body = self.load_body()
+    return self._body
+
+  def load_body(self):
+    # Like body, but without keeping it in memory
+    if self._body is None:
+      storage, key, stamp, offset = self._source
+      return storage.read_body(key, stamp, offset)
+    return self._body
+
+  @body.setter
+  def body(self, body):
+    self._body = body
+    self._source = None
+
+  @property
+  def body_html(self):
+    return render_body(self.body)
+
+  def set_source(self, storage, key, stamp, offset):
+    self._body = None
+    self._source = (storage, key, stamp, offset)
+
+  def __getitem__(self, key):
+    if key in ATTRIBUTES:
+      return getattr(self, key)
+    if self.extra and key in self.extra:
+      return self.extra[key]
+    raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    if key in INTERNED and type(value) is str:
+      value = sys.intern(value)
+    elif key == 'spouse' and type(value) is list:
+      value = [sys.intern(spouse) if type(spouse) is str else spouse for spouse in value]
+
+    if key in ATTRIBUTES:
+      setattr(self, key, value)
+    else:
+      if self.extra is None:
+        self.extra = {}
+      self.extra[key] = value
+
+  def __contains__(self, key):
+    return key in ATTRIBUTES or bool(self.extra and key in self.extra)
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def update(self, meta=(), **kwargs):
+    for key, value in dict(meta, **kwargs).items():
+      self[key] = value
+
+  def meta(self):
+    meta = {field: getattr(self, field) for field in FIELDS}
+    if self.extra:
+      meta.update(self.extra)
+    return meta
+
+  def copy(self):
+    relative = Relative(self.meta())
+    relative.spouse = list(self.spouse)
+    relative.children = list(self.children)
+    relative.siblings = list(self.siblings)
+    relative._body = self._body
+    relative._source = self._source
+    return relative
+
+_html_cache = OrderedDict()
+_html_lock = threading.Lock()
+_html_pruned = None
+
+def prune_html_cache():
+  global _html_pruned
+  with _html_lock:
+    now = time.monotonic()
+    if _html_pruned is not None and now - _html_pruned < HTML_PRUNE_INTERVAL:
+      return
+    _html_pruned = now
+  entries = []
+  for entry in os.scandir(HTML_CACHE_DIR):
+    try:
+      if entry.name.endswith('.html'):
+        entries.append((entry.stat().st_mtime_ns, entry.path))
+    except OSError:
+      pass
+  entries.sort()
+  for _, filename in entries[:max(0, len(entries) - HTML_CACHE_FILES)]:
+    try:
+      os.remove(filename)
+    except OSError:
+      pass
+
+def render_body(body):
+  if not body:
+    return ''
+
+  key = hashlib.sha256(body.encode('utf-8')).hexdigest()
+  with _html_lock:
+    if key in _html_cache:
+      _html_cache.move_to_end(key)
+      return _html_cache[key]
+
+  html = None
+  filename = os.path.join(HTML_CACHE_DIR, key + '.html') if HTML_CACHE_DIR else None
+  if filename:
+    try:
+      with open(filename, 'r') as f:
+        html = f.read()
+      os.utime(filename) # used recently
+    except OSError:
+      pass
+
+  if html is None:
+    count('markdown_renders')
+    with span('markdown'):
+      html = markdown.markdown(body)
+    if filename:
+      try:
+        with dir.replaceFile(filename) as f:
+          f.write(html)
+        prune_html_cache()
+      except OSError:
+        pass
+
+  with _html_lock:
+    _html_cache[key] = html
+    if len(_html_cache) > HTML_CACHE_SIZE:
+      _html_cache.popitem(last=False)
+  return html
+
+def copy_relative(relative):
+  return relative.copy()
+
+def file_stamp(filename):
+  try:
+    stat = os.stat(filename)
+  except OSError:
+    return None
+  return (stat.st_mtime_ns, stat.st_size)
+
+def walk_relatives(path):
+  try:
+    entries = list(os.scandir(path))
+  except OSError:
+    return
+  for entry in entries:
+    if entry.is_dir():
+      yield from walk_relatives(entry.path)
+    elif entry.name.endswith('.md'):
+      try:
+        stat = entry.stat()
+      except OSError:
+        continue
+      yield entry.path, (stat.st_mtime_ns, stat.st_size)
+
+@contextmanager
+def file_lock(filename):
+  # Serializes writers across all worker processes
+  dir.createDirIfNeeded(os.path.dirname(filename) or '.')
+  with open(filename, 'a') as file:
+    fcntl.flock(file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(file, fcntl.LOCK_UN)
+
+# A storage backend keeps the records of the relatives. Every record has a
+# key and a stamp, a tuple starting with its modification time in ns, that
+# changes whenever the record does:
+#   lock()                        context manager serializing the writers
+#   generation()                  changes with every commit, cheap to read
+#   touch()                       makes generation() change, returns it
+#   interrupted(), recover()      whether a writer crashed in a transaction,
+#                                 finishing it with the lock held returns the
+#                                 changed keys
+#   scan()                        yields the key and stamp of every record
+#   stamp(key)                    None if there is no such record
+#   load(key, stamp)              the relative and a hint for read_body
+#   read_body(key, stamp, hint)
+#   key(hash), hash(key)          where a relative is stored and the hash
+#                                 that place stands for
+#   commit(relatives, removes, fsync)
+#                                 writes the relatives and removes the keys in
+#                                 one transaction, returns the changed keys
+
+class MarkdownStorage:
+  # One Markdown file with JSON front matter per relative, anywhere below
+  # path. Keys are filenames, stamps the modification time and size.
+  def __init__(self, path):
+    self.path = path
+
+  def lock(self):
+    return file_lock(os.path.join(self.path, '.lock'))
+
+  def generation(self):
+    # The content, as two commits can fall into the same mtime tick
+    try:
+      with open(os.path.join(self.path, '.generation'), 'r') as file:
+        return int(file.read())
+    except (OSError, ValueError):
+      return None
+
+  def touch(self):
+    # Called with the lock held, so the generation always moves on
+    generation = max(time.time_ns(), (self.generation() or 0) + 1)
+    with dir.replaceFile(os.path.join(self.path, '.generation')) as file:
+      file.write(str(generation))
+    return generation
+
+  def interrupted(self):
+    return os.path.exists(journal.journal_file(self.path))
+
+  def recover(self):
+    return journal.recover(self.path)
+
+  def scan(self):
+    return walk_relatives(self.path)
+
+  def stamp(self, key):
+    return file_stamp(key)
+
+  def load(self, key, stamp):
+    relative, offset = load_relative(key)
+    if offset is not None:
+      relative.set_source(self, key, stamp, offset)
+    return relative, offset
+
+  def read_body(self, key, stamp, offset):
+    return read_body(key, stamp, offset)
+
+  def key(self, hash):
+    return os.path.join(self.path, f'{hash}.md')
+
+  def hash(self, key):
+    return os.path.basename(key)[:-3]
+
+  def commit(self, relatives, removes=(), fsync=True):
+    dir.createDirIfNeeded(self.path)
+    writes = {self.key(relative['hash']): format_relative(relative) for relative in relatives}
+    return journal.commit(self.path, writes, removes, fsync)
+
+class RelativeRepository:
+  def __init__(self, storage, snapshot=None, search_file=None):
+    self.storage = storage
+    self.snapshot = snapshot
+    self.search_file = search_file
+    self._files = {}     # key -> (stamp, relative, body offset)
+    self._relatives = {} # hash -> relative
+    self._names = {}     # hash -> name
+    self._sorted = {}    # reverse -> relatives sorted by birthday
+    self._keys = None    # sort keys of self._sorted[False]
+    self._validator = None
+    self.kinship = KinshipIndex()
+    self.dependencies = DependencyGraph()
+    self.validation = Validator()
+    self._search = None  # loaded on first use, as it needs all bodies
+    self._stamp = None
+    self._last_scan = None
+    self._saved = None   # when this process last wrote the snapshot
+    self._unsaved = False
+    self._lock = threading.RLock()
+
+  def refresh(self):
+    # Returns the hashes of the family trees that the changes found made
+    # stale
+    with self._lock:
+      self._save_snapshot(False)
+      stamp = self.storage.generation()
+      now = time.monotonic()
+      started = self._last_scan is None
+      if started:
+        # Nothing is stale for a process that hasn't seen the records before
+        with span('snapshot'):
+          current = self._read_snapshot(stamp)
+        self._stamp = stamp
+        self._last_scan = now
+        if current:
+          return set()
+        outdated = True
+      elif stamp != self._stamp:
+        outdated = True
+      elif now - self._last_scan < RESCAN_INTERVAL:
+        return set()
+      else:
+        outdated = False
+      self._stamp = stamp
+      self._last_scan = now
+
+      # A writer crashed in the middle of a transaction
+      if self.storage.interrupted():
+        with self.storage.lock():
+          if self.storage.recover():
+            self._touch()
+
+      with span('scan'):
+        changed, stale = self._scan()
+      if changed:
+        self._changed()
+      self._save_snapshot(changed or outdated)
+      return set() if started else stale
+
+  def _scan(self):
+    seen = set()
+    changed = False
+    stale = set()
+    for filename, stamp in self.storage.scan():
+      seen.add(filename)
+      cached = self._files.get(filename)
+      if cached and cached[0] == stamp:
+        continue
+      stale |= self._update(filename, (stamp, *self._load(filename, stamp)))
+      changed = True
+    for filename in set(self._files) - seen:
+      stale |= self._update(filename, None)
+      changed = True
+    return changed, stale
+
+  def commit(self, relatives, removes=(), expected=None):
+    # Writes the relatives and removes the keys in one transaction. expected
+    # maps keys to the stamps they had when they were read.
+    with self._lock, self.storage.lock():
+      # Catch up before writing, so that the written records are compared
+      # with their previous versions
+      recovered = self.storage.recover()
+      stale = self.refresh()
+      for key, stamp in (expected or {}).items():
+        if self.storage.stamp(key) != stamp:
+          raise WriteConflict(f'{key} was changed in the meantime')
+      with span('commit'):
+        changed = self.storage.commit(relatives, removes)
+      return self._reload(stale, recovered + changed)
+
+  def commit_batches(self, batches):
+    # Bulk writes: every batch of relatives is a transaction of its own and
+    # the repository is only reloaded at the end
+    with self._lock, self.storage.lock():
+      changed = self.storage.recover()
+      stale = self.refresh()
+      for relatives in batches:
+        with span('commit'):
+          changed += self.storage.commit(relatives, fsync=False)
+      return self._reload(stale, changed)
+
+  def _reload(self, stale, filenames):
+    # Loads the records written since the last refresh, stale holds the
+    # hashes of the family trees the refresh found stale
+    for filename in filenames:
+      stamp = self.storage.stamp(filename)
+      stale |= self._update(filename, (stamp, *self._load(filename, stamp)) if stamp else None)
+    self._changed()
+    self._touch()
+    self._save_snapshot()
+    return {hash for hash in stale if hash in self._relatives}
+
+  def _load(self, filename, stamp):
+    try:
+      return self.storage.load(filename, stamp)
+    except:
+      return None, None
+
+  def _read_snapshot(self, generation):
+    # Loads the snapshot into a process that has no records yet; returns
+    # whether it is the one of this generation
+    if self.snapshot is None:
+      return False
+    try:
+      with open(self.snapshot, 'rb') as file:
+        snapshot = pickle.loads(file.read())
+    except:
+      return False
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('path') != self.storage.path:
+      return False
+
+    for filename, (stamp, meta, offset) in snapshot['files'].items():
+      relative = None
+      if meta is not None:
+        relative = Relative(meta)
+        relative.set_source(self.storage, filename, stamp, offset)
+      self._update(filename, (stamp, relative, offset))
+    self._changed()
+    return snapshot.get('generation') == generation
+
+  def _save_snapshot(self, changed=True):
+    self._unsaved |= changed
+    now = time.monotonic()
+    if self._unsaved and (self._saved is None or now - self._saved >= SNAPSHOT_INTERVAL):
+      self._write_snapshot()
+      self._saved = now
+      self._unsaved = False
+
+  def _write_snapshot(self):
+    if self.snapshot is None:
+      return
+    files = {}
+    for filename, (stamp, relative, offset) in self._files.items():
+      meta = None
+      if relative is not None:
+        meta = relative.meta()
+      files[filename] = (stamp, meta, offset)
+    snapshot = {'version': SNAPSHOT_VERSION, 'path': self.storage.path, 'generation': self._stamp, 'files': files}
+
+    try:
+      with dir.replaceFile(self.snapshot, 'wb') as file:
+        pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+      pass
+
+  def _update(self, filename, entry):
+    stale = set()
+    removed = None
+    old = self._files.pop(filename, None)
+    if old and old[1] and self._relatives.get(old[1].get('hash')) is old[1]:
+      removed = old[1]
+      stale |= self._remove(removed)
+
+    if entry is None:
+      self.validation.file_removed(filename)
+      return stale
+    self._files[filename] = entry
+    relative = entry[1]
+    self.validation.file_changed(filename, relative, self.storage.hash(filename))
+    if relative and relative['hash']:
+      previous = self._relatives.get(relative['hash'])
+      if previous is not None:
+        removed = previous
+        stale |= self._remove(previous)
+      stale |= self._add(relative)
+      if removed is not None and tree_signature(removed) == tree_signature(relative):
+        return set()
+    return stale
+
+  def _add(self, relative):
+    self._relatives[relative['hash']] = relative
+    self._names[relative['hash']] = relative.get('name', '')
+    self.kinship.add(relative)
+    self.validation.changed(relative['hash'])
+    if self._search is not None:
+      self._search.add(relative, relative.load_body())
+    return self.dependencies.add(relative)
+
+  def _remove(self, relative):
+    del self._relatives[relative['hash']]
+    del self._names[relative['hash']]
+    self.kinship.remove(relative)
+    self.validation.changed(relative['hash'])
+    if self._search is not None:
+      self._search.remove(relative['hash'])
+    return self.dependencies.remove(relative)
+
+  def _changed(self):
+    self._sorted = {}
+    self._keys = None
+    self._validator = None
+
+  def _touch(self):
+    # Let the other worker processes know that they have to rescan
+    self._stamp = self.storage.touch()
+
+  def validator(self):
+    # A digest of all record stamps, the same in every worker process that
+    # has seen the same records, and the newest modification time in ns
+    self.refresh()
+    with self._lock:
+      if self._validator is None:
+        digest = hashlib.sha256()
+        modified = 0
+        for filename, (stamp, _, _) in sorted(self._files.items()):
+          digest.update(f'{filename}\0{stamp}\n'.encode('utf-8'))
+          modified = max(modified, stamp[0])
+        self._validator = (digest.hexdigest()[:32], modified)
+      return self._validator
+
+  def get(self, hash):
+    self.refresh()
+    return self._relatives.get(hash)
+
+  def exists(self, hash):
+    return self.get(hash) is not None
+
+  def names(self, hashes):
+    self.refresh()
+    return {hash: self._names.get(hash) for hash in hashes}
+
+  def search(self, query):
+    self.refresh()
+    with self._lock:
+      if self._search is None:
+        with span('search_index'):
+          self._search = self._load_search_index()
+      with span('search'):
+        return [hash for hash, _ in self._search.search(query)]
+
+  def _load_search_index(self):
+    # The saved index, brought up to date with the records
+    stamps = {relative['hash']: (filename, stamp) for filename, (stamp, relative, _) in self._files.items()
+              if relative is not None and self._relatives.get(relative['hash']) is relative}
+    index = SearchIndex()
+    indexed = {}
+    try:
+      with open(self.search_file or '', 'rb') as file:
+        saved = pickle.loads(file.read())
+      if saved.get('version') == SEARCH_VERSION and saved.get('path') == self.storage.path:
+        index.postings, index.documents = saved['postings'], saved['documents']
+        indexed = saved['stamps']
+    except:
+      pass
+
+    changed = False
+    for hash in list(index.documents):
+      if indexed.get(hash) != stamps.get(hash):
+        index.remove(hash)
+        changed = True
+    for hash in stamps.keys() - index.documents.keys():
+      relative = self._relatives[hash]
+      index.add(relative, relative.load_body())
+      changed = True
+
+    if changed and self.search_file:
+      saved = {'version': SEARCH_VERSION, 'path': self.storage.path, 'stamps': stamps,
+               'postings': index.postings, 'documents': index.documents}
+      try:
+        with dir.replaceFile(self.search_file, 'wb') as file:
+          pickle.dump(saved, file, protocol=pickle.HIGHEST_PROTOCOL)
+      except OSError:
+        pass
+    return index
+
+  def kinship_query(self, function, *args):
+    self.refresh()
+    with self._lock:
+      return function(self.kinship, *args)
+
+  def findings(self):
+    self.refresh()
+    with self._lock, span('validate'):
+      self.validation.update(self._relatives, self.kinship)
+      return len(self._relatives), self.validation.warnings()
+
+  def check_edit(self, relative, old_hash):
+    self.refresh()
+    with self._lock:
+      return check_edit(relative, old_hash, self._relatives, self.kinship)
+
+  def by_birthday(self, hashes, reverse=True):
+    relatives = [self._relatives[hash] for hash in hashes if hash in self._relatives]
+    relatives.sort(key=get_birthday, reverse=reverse)
+    return [relative['hash'] for relative in relatives]
+
+  def chart(self, hash, up, down):
+    self.refresh()
+    with self._lock:
+      return layout.layout_chart(self.kinship, hash, up, down, lambda hashes: self.by_birthday(hashes, reverse=False))
+
+  def children(self, hash):
+    self.refresh()
+    return self.by_birthday(self.kinship.children_of(hash))
+
+  def siblings(self, hash):
+    self.refresh()
+    return self.by_birthday(self.kinship.siblings_of(hash))
+
+  def dependent_trees(self, hash):
+    self.refresh()
+    return self.by_birthday(self.dependencies.trees_showing(hash))
+
+  def portraits(self):
+    self.refresh()
+    with self._lock:
+      return self.dependencies.portraits()
+
+  def trees_using_images(self, images):
+    self.refresh()
+    with self._lock:
+      return self.dependencies.trees_using_images(images)
+
+  def spouse_of(self, hash):
+    self.refresh()
+    return self.by_birthday(self.kinship.spouse_of(hash))
+
+  def sorted(self, reverse=True):
+    self.refresh()
+    with self._lock:
+      if reverse not in self._sorted:
+        self._sorted[reverse] = sorted(self._relatives.values(), key=sort_key, reverse=reverse)
+      return self._sorted[reverse]
+
+  def page(self, cursor=None, limit=0, reverse=True, accept=None, first=None, last=None):
+    # The relatives following the sort key cursor with keys in [first, last)
+    # that are accepted, and the key to continue from if there are more
+    with self._lock:
+      relatives = self.sorted(False)
+      if self._keys is None:
+        self._keys = [sort_key(relative) for relative in relatives]
+      keys = self._keys
+
+      lo = 0 if first is None else bisect.bisect_left(keys, first)
+      hi = len(keys) if last is None else bisect.bisect_left(keys, last)
+      if cursor is not None and reverse:
+        hi = min(hi, bisect.bisect_left(keys, cursor))
+      elif cursor is not None:
+        lo = max(lo, bisect.bisect_right(keys, cursor))
+
+      selected = []
+      for i in range(hi - 1, lo - 1, -1) if reverse else range(lo, hi):
+        if accept is None or accept(relatives[i]):
+          if limit and len(selected) == limit:
+            return selected, sort_key(selected[-1])
+          selected.append(relatives[i])
+      return selected, None
+
+def open_storage(name):
+  # 'markdown' or 'sqlite'
+  if name == 'markdown':
+    return MarkdownStorage(DIR)
+  if name == 'sqlite':
+    from genealogy.sqlite import SQLiteStorage
+    return SQLiteStorage(DATABASE)
+  raise ValueError(f'unknown storage {name}')
+
+def open_repository(name):
+  # Parsing all Markdown files is slow, so their front matter is cached in a
+  # snapshot; the database reads as fast as the snapshot would
+  storage = open_storage(name)
+  return RelativeRepository(storage, SNAPSHOT_FILE if name == 'markdown' else None, SEARCH_FILE)
+
+repository = open_repository(app.config['STORAGE'])
+
+class WriteConflict(RuntimeError):
+  pass
+
+def format_relative(relative):
+  # Values are JSON encoded, which only differs from writing them in quotes
+  # for quotes, backslashes and control characters. Front matter keys
+  # outside FIELDS are kept after them.
+  value = lambda key: json.dumps(relative[key], ensure_ascii=False)
+  extra = getattr(relative, 'extra', None) or {}
+  return ('---\n'
+          f'"hash":         {value("hash")},\n'
+          f'"name":         {value("name")},\n'
+          f'"sex":          {value("sex")},\n'
+          f'"father":       {value("father")},\n'
+          f'"mother":       {value("mother")},\n'
+          f'"spouse":       {value("spouse")},\n'
+          f'"birthday":     {value("birthday")},\n'
+          f'"birthplace":   {value("birthplace")},\n'
+          f'"weddingDay":   {value("weddingDay")},\n'
+          f'"weddingPlace": {value("weddingPlace")},\n'
+          f'"dayOfDeath":   {value("dayOfDeath")},\n'
+          f'"placeOfDeath": {value("placeOfDeath")},\n'
+          f'"profession":   {value("profession")},\n'
+          f'"image":        {value("image")}' +
+          ''.join(f',\n{json.dumps(key, ensure_ascii=False)}: {value(key)}' for key in extra) +
+          '\n---\n' +
+          relative['body'])
+
 def write_relative(relative: dict):
-  DIR = 'data/relatives/'
-  dir.createDirIfNeeded(DIR)
-
-  filename = f'{relative["hash"]}.md'
-
-  spouse = str(relative["spouse"]).replace("'", '"')
-  with open(os.path.join(DIR, filename), mode='w') as file:
-    file.write('---\n')
-    file.write(f'"hash":         "{relative["hash"]}",\n')
-    file.write(f'"name":         "{relative["name"]}",\n')
-    file.write(f'"sex":          "{relative["sex"]}",\n')
-    file.write(f'"father":       "{relative["father"]}",\n')
-    file.write(f'"mother":       "{relative["mother"]}",\n')
-    file.write(f'"spouse":       {spouse},\n')
-    file.write(f'"birthday":     "{relative["birthday"]}",\n')
-    file.write(f'"birthplace":   "{relative["birthplace"]}",\n')
-    file.write(f'"weddingDay":   "{relative["weddingDay"]}",\n')
-    file.write(f'"weddingPlace": "{relative["weddingPlace"]}",\n')
-    file.write(f'"dayOfDeath":   "{relative["dayOfDeath"]}",\n')
-    file.write(f'"placeOfDeath": "{relative["placeOfDeath"]}",\n')
-    file.write(f'"profession":   "{relative["profession"]}",\n')
-    file.write(f'"image":        "{relative["image"]}"\n')
-    file.write('---\n')
-    file.write(relative['body'])
+  return write_relatives([relative])
+
+def record_stamp(relative):
+  # The key and stamp of the record a relative was read from, None if it
+  # wasn't read from the repository or its body was replaced
+  source = getattr(relative, '_source', None)
+  return source and source[1:3]
+
+def write_relatives(relatives, renames=(), read=()):
+  # Writes the relatives and removes the records of the old hashes of
+  # renamed ones in one transaction; returns the hashes of the stale family
+  # trees. read lists further record stamps of the relatives, taken before
+  # they were changed.
+  removes = [repository.storage.key(old_hash) for old_hash, _ in renames]
+  # Records read from the repository must not have changed since
+  expected = dict(stamp for stamp in map(record_stamp, relatives) if stamp)
+  expected.update(read)
+  return repository.commit(relatives, removes, expected)
 
 def get_birthday(relative):
   birthday = relative['birthday'].split('.')
@@ -58,52 +816,115 @@ def get_birthday(relative):
     return f"{birthday[2]}-{birthday[1]}-{birthday[0]}"
   return relative['birthday']
 
-def get_relative_name(hash):
-  if not hash:
-    return ''
+def sort_key(relative):
+  # Relatives with the same birthday are ordered by hash, so that the key
+  # identifies a position in the listing
+  return (get_birthday(relative), relative['hash'])
+
+def encode_cursor(key):
+  return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
 
+def decode_cursor(cursor):
   try:
-    relative = read_relative(os.path.join('data/relatives/', hash + '.md'))
-    if relative['name']:
-      return relative['name']
+    key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+  except ValueError:
+    raise ValueError(f'invalid cursor: {cursor}')
+  if not isinstance(key, list) or len(key) != 2 or not all(isinstance(part, str) for part in key):
+    raise ValueError(f'invalid cursor: {cursor}')
+  return tuple(key)
+
+def read_relatives_page(cursor=None, limit=PAGE_SIZE, reverse=True, sex=None, birthplace=None, born_from=None, born_to=None):
+  # Returns a page of relatives ordered by birthday and the cursor of the
+  # next page, None on the last one; raises ValueError for invalid cursors
+  def accept(relative):
+    if sex and relative['sex'] != sex:
+      return False
+    if birthplace and fold(relative['birthplace']) != fold(birthplace):
+      return False
+    return True
+
+  # Birthdays sort as YYYY-MM-DD, so a range of years is a range of keys
+  first = (f'{born_from:04d}',) if born_from is not None else None
+  last = (f'{born_to + 1:04d}',) if born_to is not None else None
+  key = decode_cursor(cursor) if cursor else None
+  relatives, next = repository.page(key, max(limit, 0), reverse, accept if sex or birthplace else None, first, last)
+  return [copy_relative(relative) for relative in relatives], next and encode_cursor(next)
+
+def get_relative(hash):
+  relative = repository.get(hash)
+  if relative is None:
+    return None
+  return copy_relative(relative)
+
+def relative_exists(hash):
+  return repository.exists(hash)
+
+def get_children(hash):
+  return repository.children(hash)
+
+def get_siblings(hash):
+  return repository.siblings(hash)
+
+def get_spouse_references(hash):
+  return repository.spouse_of(hash)
+
+def search_relatives(query):
+  relatives = [repository.get(hash) for hash in repository.search(query)]
+  return [copy_relative(relative) for relative in relatives if relative is not None]
+
+def get_ancestors(hash, generations):
+  return repository.kinship_query(pedigree.ancestors, hash, generations)
+
+def get_descendants(hash, generations):
+  return repository.kinship_query(pedigree.descendants, hash, generations)
+
+def get_common_ancestors(a, b):
+  return repository.kinship_query(pedigree.common_ancestors, a, b)
+
+def get_relationship_path(a, b):
+  return repository.kinship_query(pedigree.relationship_path, a, b)
+
+def get_chart(hash, up, down):
+  return repository.chart(hash, up, down)
+
+def get_dependent_trees(hash):
+  return repository.dependent_trees(hash)
+
+def get_portraits():
+  return repository.portraits()
+
+def get_trees_using_images(images):
+  return sorted(repository.trees_using_images(set(images)))
+
+def get_validator():
+  return repository.validator()
+
+def get_findings():
+  return repository.findings()
+
+def check_relative(relative, old_hash):
+  return repository.check_edit(relative, old_hash)
+
+def get_relative_name(hash):
+  return get_relative_names([hash])[hash]
+
+def get_relative_names(hashes):
+  count('names_resolved', len(hashes))
+  names = {}
+  for hash, name in repository.names(hashes).items():
+    if not hash:
+      names[hash] = ''
+    elif name is None:
+      names[hash] = 'Failed to resolve hash: ' + hash
     else:
-      return hash
-  except:
-    return 'Failed to resolve hash: ' + hash
+      names[hash] = name or hash
+  return names
 
 def read_all_relatives(max_posts=-1, reverse=True):
-  relatives = []
-
-  for root, _, files in os.walk('data/relatives/', topdown=False):
-    for name in files:
-      if name.endswith('.md'):
-        try:
-          post = read_relative(os.path.join(root, name))
-        except:
-          pass
-        else:
-          relatives.append(post)
-
-  relatives.sort(key=get_birthday, reverse=reverse)
+  relatives = repository.sorted(reverse)
   if max_posts > 0:
-    return relatives[0:max_posts]
-  return relatives
+    relatives = relatives[0:max_posts]
+  return [copy_relative(relative) for relative in relatives]
 
 def empty_relative(hash):
-  relative = {'hash': hash,
-              'name': '',
-              'sex': '',
-              'father': '',
-              'mother': '',
-              'spouse': [],
-              'birthday': '',
-              'birthplace': '',
-              'weddingDay': '',
-              'weddingPlace': '',
-              'dayOfDeath': '',
-              'placeOfDeath': '',
-              'profession': '',
-              'image': 'unknown.png',
-              'body': '',
-              'body_html': ''}
-  return relative
+  return Relative({'hash': hash, 'image': 'unknown.png'})
@@ -1,34 +1,63 @@
 import ast
+import cProfile
+import io
 import os
 import subprocess
+import time
 from datetime import datetime
 
 import flask_login
-from flask import (abort, flash, redirect, render_template, request,
-                   send_from_directory, url_for)
+from flask import (Response, abort, flash, g, jsonify, redirect, render_template,
+                   request, send_file, send_from_directory, stream_template, url_for)
 
 from genealogy import app, dir, login_manager
-from genealogy.relatives import (empty_relative, read_all_relatives,
-                                 read_relative, write_relative)
-from genealogy.user import (User, add_new_user, load_users)
-
-from genealogy.graph import generate_tree
-
+from genealogy import layout, pedigree
+from genealogy.relatives import (PAGE_SIZE, check_relative, empty_relative, get_ancestors, get_children,
+                                 get_common_ancestors, get_dependent_trees,
+                                 get_descendants, get_findings, get_relationship_path,
+                                 get_relative,
+                                 get_relative_names, get_siblings,
+                                 get_spouse_references,
+                                 read_all_relatives,
+                                 read_relatives_page, record_stamp,
+                                 relative_exists, search_relatives,
+                                 WriteConflict, write_relatives)
+from genealogy.user import (User, add_new_user, find_user_by_token,
+                            load_users)
+
+from genealogy.gedcom import export_gedcom, import_gedcom
+from genealogy.graph import generate_svg, generate_tex, generate_tree
+from genealogy.jobs import job_status, submit_trees
+from genealogy import thumbnails
+from genealogy.log import request_log
+from genealogy.metrics import metrics
+from genealogy.pagecache import cached_page
+
+
+@app.before_request
+def before_request():
+  g.request_start = time.perf_counter()
+  if app.config['PROFILE_SLOW_REQUESTS'] is not None:
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
 
 @app.after_request
 def after_request(response):
   timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-  DIR = 'data/log/'
-  dir.createDirIfNeeded(DIR)
-
-  filename = 'requests.md'
-  open(os.path.join(DIR, filename), 'a').close() # make sure it exists
-
-  with open(os.path.join(DIR, filename), "a") as file:
-    file.write('| {} | {} | {} | {} | {} | {} |\n'.format(timestamp, request.remote_addr, request.method, request.scheme, request.full_path, response.status))
+  duration = time.perf_counter() - g.request_start if 'request_start' in g else 0
+  request_log.log('| {} | {} | {} | {} | {} | {} | {:.1f} ms |\n'.format(timestamp, request.remote_addr, request.method, request.scheme, request.full_path, response.status, duration * 1000))
+  metrics.finish_request(request.endpoint or 'none', duration)
+
+  if 'profiler' in g:
+    g.profiler.disable()
+    if duration >= app.config['PROFILE_SLOW_REQUESTS']:
+      DIR = 'data/log/profiles/'
+      dir.createDirIfNeeded(DIR)
+      g.profiler.dump_stats(os.path.join(DIR, f'{datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{request.endpoint}.prof'))
   return response
 
 @app.route('/')
+@cached_page
 def index():
   relatives = read_all_relatives(6, reverse=True)
   return render_template('index.html', relatives=relatives)
@@ -45,38 +74,104 @@ def elements():
 
 @app.route('/relatives')
 @flask_login.login_required
+@cached_page
 def relatives():
-  relatives = read_all_relatives()
-  return render_template('relatives.html', relatives=relatives)
+  # ?limit=0 lists everybody, ?stream=1 sends the page while it's rendered
+  limit = request.args.get('limit', PAGE_SIZE, type=int)
+  try:
+    relatives, cursor = read_relatives_page(request.args.get('cursor'), limit)
+  except ValueError:
+    abort(400)
+
+  next_url = url_for('relatives', cursor=cursor, limit=limit) if cursor else None
+  if request.args.get('stream', 0, type=int):
+    return stream_template('relatives.html', relatives=relatives, next_url=next_url)
+  return render_template('relatives.html', relatives=relatives, next_url=next_url)
+
+@app.route('/relatives.json')
+@flask_login.login_required
+def relatives_json():
+  try:
+    relatives, cursor = read_relatives_page(request.args.get('cursor'), request.args.get('limit', PAGE_SIZE, type=int),
+                                            reverse=request.args.get('order', 'desc') != 'asc',
+                                            sex=request.args.get('sex'), birthplace=request.args.get('birthplace'),
+                                            born_from=request.args.get('born_from', type=int),
+                                            born_to=request.args.get('born_to', type=int))
+  except ValueError:
+    abort(400)
+  return jsonify({'relatives': [relative.meta() for relative in relatives], 'next': cursor})
 
 @app.route('/relatives/<relative_hash>')
 @flask_login.login_required
+@cached_page
 def relative(relative_hash):
-  relatives = read_all_relatives()
-  ego = [p for p in relatives if p['hash'] == relative_hash]
+  ego = get_relative(relative_hash)
   if ego:
-    ego = ego[0]
-    children = [p['hash'] for p in relatives if p['father'] == relative_hash or p['mother'] == relative_hash]
-    siblings = [p['hash'] for p in relatives if ((ego['father'] and p['father'] == ego['father']) or (ego['mother'] and p['mother'] == ego['mother'])) and p['hash'] != relative_hash]
-    ego['children'] = children
-    ego['siblings'] = siblings
+    ego['children'] = get_children(relative_hash)
+    ego['siblings'] = get_siblings(relative_hash)
   else:
     ego = empty_relative(relative_hash)
-  return render_template('relative.html', relative=ego)
+  names = get_relative_names([ego['father'], ego['mother']] + ego['spouse'] + ego['children'] + ego['siblings'])
+  return render_template('relative.html', relative=ego, names=names)
+
+@app.route('/relatives/<relative_hash>/ancestors')
+@app.route('/relatives/<relative_hash>/descendants')
+@flask_login.login_required
+def relative_pedigree(relative_hash):
+  ego = get_relative(relative_hash)
+  if not ego:
+    return render_template('404.html'), 404
+
+  generations = request.args.get('generations', 5, type=int)
+  if request.path.endswith('/ancestors'):
+    direction = 'Ancestors'
+    result = get_ancestors(relative_hash, generations)
+  else:
+    direction = 'Descendants'
+    result = get_descendants(relative_hash, generations)
+
+  collapse = pedigree.pedigree_collapse(result)
+  names = get_relative_names({hash for generation in result for hash in generation})
+  return render_template('pedigree.html', relative=ego, direction=direction, generations=result, collapse=collapse, names=names)
+
+@app.route('/relatives/<relative_hash>/chart.svg')
+@app.route('/relatives/<relative_hash>/chart.tex')
+@flask_login.login_required
+def relative_chart(relative_hash):
+  if not relative_exists(relative_hash):
+    return render_template('404.html'), 404
+
+  up = max(0, min(request.args.get('up', 3, type=int), layout.MAX_GENERATIONS))
+  down = max(0, min(request.args.get('down', 3, type=int), layout.MAX_GENERATIONS))
+  if request.path.endswith('.tex'):
+    return Response(generate_tex(relative_hash, up, down), mimetype='application/x-tex')
+
+  image_url = lambda image: url_for('static', filename=f'images/relatives/{image}')
+  return Response(generate_svg(relative_hash, image_url, up, down), mimetype='image/svg+xml')
+
+@app.route('/relatives/<relative_hash>/relationship/<other_hash>')
+@flask_login.login_required
+def relationship(relative_hash, other_hash):
+  if not relative_exists(relative_hash) or not relative_exists(other_hash):
+    return render_template('404.html'), 404
+
+  path = get_relationship_path(relative_hash, other_hash)
+  common = get_common_ancestors(relative_hash, other_hash)
+  names = get_relative_names([hash for hash, _ in path or []] + [hash for hash, _, _ in common] + [relative_hash, other_hash])
+  return render_template('relationship.html', a=relative_hash, b=other_hash, path=path, common=common, names=names)
 
 @app.route('/relatives/<relative_hash>/edit', methods=['GET', 'POST'])
 @flask_login.login_required
 def relative_edit(relative_hash):
-  relatives = read_all_relatives()
-  relative = [p for p in relatives if p['hash'] == relative_hash]
-  if relative:
-    relative = relative[0]
-  else:
+  relative = get_relative(relative_hash)
+  if not relative:
     relative = empty_relative(relative_hash)
 
   if request.method == 'GET':
     return render_template('relative_edit.html', relative=relative)
 
+  # Setting the body forgets where the record came from
+  read = record_stamp(relative)
   new_hash = request.form['hash']
   relative['name'] = request.form['name']
   relative['sex'] = request.form['sex']
@@ -93,45 +188,41 @@ def relative_edit(relative_hash):
   relative['body'] = request.form['body']
 
   # Check that the new hash isn't already used
-  if relative_hash != new_hash:
-    for r in relatives:
-      if new_hash == r['hash']:
-        flash('Warning: Unable to modify hash, as it already exists.')
-        return redirect(url_for('relative', relative_hash=relative_hash))
+  if relative_hash != new_hash and relative_exists(new_hash):
+    flash('Warning: Unable to modify hash, as it already exists.')
+    return redirect(url_for('relative', relative_hash=relative_hash))
 
   if relative['father']:
-    found = False
-    for r in relatives:
-      if relative['father'] == r['hash']:
-        found = True
-        break
-    if not found:
+    if not relative_exists(relative['father']):
       flash('Warning: Unable to find father, invalid cross-reference')
       return redirect(url_for('relative', relative_hash=relative_hash))
 
   if relative['mother']:
-    found = False
-    for r in relatives:
-      if relative['mother'] == r['hash']:
-        found = True
-        break
-    if not found:
+    if not relative_exists(relative['mother']):
       flash('Warning: Unable to find mother, invalid cross-reference')
       return redirect(url_for('relative', relative_hash=relative_hash))
 
   for spouse in relative['spouse']:
-    found = False
-    for r in relatives:
-      if spouse == r['hash']:
-        found = True
-        break
-    if not found:
+    if not relative_exists(spouse):
       flash(f'Warning: Unable to find spouse "{spouse}", invalid cross-reference')
       return redirect(url_for('relative', relative_hash=relative_hash))
 
-  # Change all cross-references
+  # Refuse changes that make the data inconsistent
+  relative['hash'] = new_hash
+  errors = check_relative(relative, relative_hash)
+  relative['hash'] = relative_hash
+  if errors:
+    for error in errors:
+      flash(f'Warning: Unable to save, {error}')
+    return redirect(url_for('relative', relative_hash=relative_hash))
+
+  # Change all cross-references, and write them together with the relative
+  # in one transaction
+  changed = []
+  renames = []
   if relative_hash != new_hash:
-    for r in relatives:
+    referencing = set(get_children(relative_hash)) | set(get_spouse_references(relative_hash))
+    for r in [get_relative(hash) for hash in sorted(referencing)]:
       need_to_be_updated = False
       if r['father'] == relative_hash:
         need_to_be_updated = True
@@ -143,90 +234,106 @@ def relative_edit(relative_hash):
         need_to_be_updated = True
         r['spouse'] = [s if s != relative_hash else new_hash for s in r['spouse']]
       if need_to_be_updated:
-        write_relative(r)
+        changed.append(r)
         flash(f'Info: Cross-references updated for "{r["hash"]}"')
 
-  if relative_hash != new_hash:
     relative['hash'] = new_hash
-    os.rename('data/relatives/' + relative_hash + '.md', 'data/relatives/' + relative['hash'] + '.md')
-    relative_hash = relative['hash']
-
-  write_relative(relative)
-
-  generate_tree(relative['hash'])
+    renames.append((relative_hash, new_hash))
+    relative_hash = new_hash
+
+  # Collect the family trees that show outdated information
+  try:
+    stale = write_relatives(changed + [relative], renames, [read] if read else [])
+  except WriteConflict as e:
+    flash(f'Warning: Unable to save, {e}')
+    return redirect(url_for('relative', relative_hash=renames[0][0] if renames else relative_hash))
+
+  stale = sorted(hash for hash in stale if relative_exists(hash))
+  if stale:
+    submit_trees(stale)
+    flash(f'Info: {len(stale)} family trees are being updated in the background')
   return redirect(url_for('relative', relative_hash=relative_hash))
 
 @app.route('/relatives/<relative_hash>/update')
 @flask_login.login_required
 def relative_update(relative_hash):
-  relatives = read_all_relatives()
-  ego = [p for p in relatives if p['hash'] == relative_hash]
-  if ego:
-    ego = ego[0]
-  else:
+  ego = get_relative(relative_hash)
+  if not ego:
     return render_template('404.html'), 404
 
-  children = [p['hash'] for p in relatives if p['father'] == relative_hash or p['mother'] == relative_hash]
-
-  generate_tree(ego['hash'])
-  if ego['father']:
-    generate_tree(ego['father'])
-  if ego['mother']:
-    generate_tree(ego['mother'])
-  for spouse in ego['spouse']:
-    generate_tree(spouse)
-  for child in children:
-    generate_tree(child)
+  hashes = get_dependent_trees(relative_hash)
+  submit_trees(hashes)
+  flash(f'Info: {len(hashes)} family trees are being updated in the background')
   return redirect(url_for('relative', relative_hash=relative_hash))
 
 @app.route('/generate/<relative_hash>')
 @flask_login.login_required
 def generate(relative_hash):
-  generate_tree(relative_hash)
+  if not get_relative(relative_hash):
+    return render_template('404.html'), 404
+
+  generate_tree(relative_hash, app.config['TREE_TIMEOUT'], force=True, backend=app.config['TREE_BACKEND'])
   return 'Ok ' + relative_hash
 
 @app.route('/generate')
 @flask_login.login_required
 def generate_all():
-  relatives = read_all_relatives()
-  for p in relatives:
-    generate_tree(p['hash'])
-  return 'Ok'
+  hashes = [p['hash'] for p in read_all_relatives()]
+  force = request.args.get('force', '') == '1'
+  # Rendering the whole archive takes longer than a request may
+  submitted = submit_trees(hashes, force)
+  progress = url_for('jobs')
+  return f'{len(submitted)} family trees queued, {len(hashes) - len(submitted)} already pending</br></br><a href="{progress}">Progress</a>'
+
+@app.route('/jobs')
+@flask_login.login_required
+def jobs():
+  return jsonify(job_status())
+
+@app.route('/metrics')
+@flask_login.login_required
+def metrics_endpoint():
+  if flask_login.current_user.role != 'admin':
+    abort(403)
+  return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 @app.route('/validate')
 @flask_login.login_required
 def validate():
-  relatives = {}
-  warnings = []
-
-  # import all data
-  for root, _, files in os.walk('data/relatives/', topdown=False):
-    for name in files:
-      if name.endswith('.md'):
-        try:
-          relative = read_relative(os.path.join(root, name))
-          if relative['hash'] != name[:-3]:
-            warnings.append('Wrong filename ' + os.path.join(root, name))
-        except:
-          warnings.append('Failed to read ' + os.path.join(root, name))
-        else:
-          relatives[relative['hash']] = relative
-
-  for relative in relatives.values():
-    if relative['father'] and relative['father'] not in relatives:
-      warnings.append(relative['hash'] + " has an invalid cross-reference to their father " + relative['father'])
-    if relative['mother'] and relative['mother'] not in relatives:
-      warnings.append(relative['hash'] + " has an invalid cross-reference to their mother " + relative['mother'])
-    for spouse in relative['spouse']:
-      if not spouse:
-        warnings.append(relative['hash'] + " contains an empty spouse entry")
-      else:
-        if spouse not in relatives:
-          warnings.append(relative['hash'] + " has an invalid cross-reference to their spouse " + spouse)
-        if relative['hash'] not in relatives[spouse]['spouse']:
-          warnings.append(spouse + " is missing a cross-reference to their spouse " + relative['hash'])
+  count, warnings = get_findings()
+  return f'{count} relatives, {len(warnings)} warnings</br></br>' + '</br>'.join(warnings)
+
+@app.route('/export.ged')
+@flask_login.login_required
+def export():
+  return Response(export_gedcom(), mimetype='text/x-gedcom',
+                  headers={'Content-Disposition': 'attachment; filename=genealogy.ged'})
 
-  return f'{len(relatives)} relatives, {len(warnings)} warnings</br></br>' + '</br>'.join(warnings)
+@app.route('/import', methods=['GET', 'POST'])
+@flask_login.login_required
+def import_():
+  if flask_login.current_user.role != 'admin':
+    abort(403)
+  if request.method == 'GET':
+    return render_template('import.html')
+
+  upload = request.files.get('file')
+  if not upload or not upload.filename:
+    flash('Warning: Unable to import, no file selected')
+    return redirect(url_for('import_'))
+  # The upload is spooled to a temporary file, which the import reads twice
+  file = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', errors='replace')
+  try:
+    imported, stale = import_gedcom(file)
+  except ValueError as e:
+    flash(f'Warning: Unable to import, {e}')
+    return redirect(url_for('import_'))
+  flash(f'Info: {imported} relatives imported')
+  stale = sorted(hash for hash in stale if relative_exists(hash))
+  if stale:
+    submit_trees(stale)
+    flash(f'Info: {len(stale)} family trees are being updated in the background')
+  return redirect(url_for('relatives'))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -252,19 +359,15 @@ def login():
 
 @app.route('/login/<token>')
 def login_with_token(token):
-  users = load_users()
-  for email in users:
-    name = users[email]['name']
-    role = users[email]['role']
-    password = users[email]['password']
-    if password == token:
-      if role == 'inactive':
-        flash('User is not yet activated')
-      else:
-        user = User(name, email, role)
-        flask_login.login_user(user)
-        return redirect(url_for('relatives'))
-  flash('Bad login')
+  email, user = find_user_by_token(token)
+  if user:
+    if user['role'] == 'inactive':
+      flash('User is not yet activated')
+    else:
+      flask_login.login_user(User(user['name'], email, user['role']))
+      return redirect(url_for('relatives'))
+  else:
+    flash('Bad login')
   return redirect(url_for('login'))
 
 @app.route('/signup', methods=['POST'])
@@ -304,9 +407,8 @@ def search():
 
   query = request.form['query']
 
-  all_relatives = read_all_relatives()
-  all_relatives = [relative for relative in all_relatives if query.lower() in relative['name'].lower()]
-  return render_template('search.html', relatives=all_relatives, query=query)
+  relatives = search_relatives(query)
+  return render_template('search.html', relatives=relatives, query=query)
 
 @app.route('/contact', methods=['GET', 'POST'])
 def contact():
@@ -347,6 +449,27 @@ def contact():
     file.write(message)
     return redirect(url_for('index'))
 
+@app.route('/thumbnails/<int:width>/<path:image>')
+@flask_login.login_required
+def thumbnail(width, image):
+  # URLs carry the version of the source in ?v=, so they can be cached forever
+  if width not in thumbnails.WIDTHS or thumbnails.source_path(image) is None:
+    return render_template('404.html'), 404
+
+  if thumbnails.available():
+    format = thumbnails.accepted_format(request.accept_mimetypes)
+    path, key = thumbnails.thumbnail(image, width, format)
+    response = send_file(os.path.abspath(path), mimetype=thumbnails.FORMATS[format][1],
+                         etag=f'{key}-{width}.{format}', max_age=thumbnails.MAX_AGE, conditional=True)
+    response.vary.add('Accept')
+  else:
+    response = send_file(thumbnails.source_path(image), etag=thumbnails.version(image),
+                         max_age=thumbnails.MAX_AGE, conditional=True)
+  response.cache_control.public = False
+  response.cache_control.private = True
+  response.cache_control.immutable = True
+  return response
+
 @app.route('/favicon.ico')
 def favicon():
   return send_from_directory(app.static_folder, 'favicon/favicon.ico', mimetype='image/vnd.microsoft.icon')
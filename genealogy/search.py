@@ -0,0 +1,113 @@
+import bisect
+import re
+import unicodedata
+
+
+# Searchable fields with their weight for ranking
+FIELDS = ['name', 'profession', 'birthplace', 'weddingPlace', 'placeOfDeath', 'body']
+WEIGHTS = [10, 3, 2, 2, 2, 1]
+
+# Field names accepted in queries such as "birthplace:köln", "place" covers
+# all places
+ALIASES = {field.lower(): 1 << i for i, field in enumerate(FIELDS)}
+ALIASES['place'] = ALIASES['birthplace'] | ALIASES['weddingplace'] | ALIASES['placeofdeath']
+
+# Prefix matches count less than complete words
+PREFIX_FACTOR = 0.5
+
+GERMAN = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss'})
+
+
+def fold(text):
+  text = unicodedata.normalize('NFKD', text.casefold())
+  return ''.join(c for c in text if not unicodedata.combining(c))
+
+def words(text):
+  return re.findall(r'\w+', text.casefold())
+
+def index_tokens(text):
+  # Both "Müller" and "Mueller" have to find "Müller"
+  tokens = set()
+  for word in words(text):
+    tokens.add(fold(word))
+    tokens.add(fold(word.translate(GERMAN)))
+  return tokens
+
+def parse_query(query):
+  terms = []
+  for part in query.split():
+    mask = (1 << len(FIELDS)) - 1
+    field, _, text = part.partition(':')
+    if text and field.lower() in ALIASES:
+      mask = ALIASES[field.lower()]
+      part = text
+    terms += [(fold(word), mask) for word in words(part)]
+  return terms
+
+def score(fields, mask):
+  return sum(WEIGHTS[i] for i in range(len(FIELDS)) if fields & mask & (1 << i))
+
+class SearchIndex:
+  def __init__(self):
+    self.postings = {}  # token -> {hash: bitmask of the fields containing it}
+    self.documents = {} # hash -> tokens
+    self._vocabulary = None
+
+  def add(self, relative, body):
+    hash = relative['hash']
+    self.remove(hash)
+
+    tokens = {}
+    for i, field in enumerate(FIELDS):
+      text = body if field == 'body' else relative.get(field, '')
+      for token in index_tokens(str(text)):
+        tokens[token] = tokens.get(token, 0) | (1 << i)
+
+    for token, fields in tokens.items():
+      if token not in self.postings:
+        self.postings[token] = {}
+        self._vocabulary = None
+      self.postings[token][hash] = fields
+    self.documents[hash] = set(tokens)
+
+  def remove(self, hash):
+    for token in self.documents.pop(hash, ()):
+      postings = self.postings[token]
+      del postings[hash]
+      if not postings:
+        del self.postings[token]
+        self._vocabulary = None
+
+  def vocabulary(self):
+    if self._vocabulary is None:
+      self._vocabulary = sorted(self.postings)
+    return self._vocabulary
+
+  def matches(self, term, mask):
+    vocabulary = self.vocabulary()
+    matches = {}
+    i = bisect.bisect_left(vocabulary, term)
+    while i < len(vocabulary) and vocabulary[i].startswith(term):
+      token = vocabulary[i]
+      factor = 1 if token == term else PREFIX_FACTOR
+      for hash, fields in self.postings[token].items():
+        value = score(fields, mask) * factor
+        if value > matches.get(hash, 0):
+          matches[hash] = value
+      i += 1
+    return matches
+
+  def search(self, query):
+    # Returns (hash, score) of the relatives matching all terms, best first
+    results = None
+    for term, mask in parse_query(query):
+      matches = self.matches(term, mask)
+      if results is None:
+        results = matches
+      else:
+        results = {hash: value + matches[hash] for hash, value in results.items() if hash in matches}
+      if not results:
+        return []
+    if results is None:
+      return []
+    return sorted(results.items(), key=lambda result: (-result[1], result[0]))
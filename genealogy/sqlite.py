@@ -0,0 +1,147 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from genealogy import dir
+from genealogy.metrics import count
+from genealogy.relatives import FIELDS, Relative, file_lock, get_birthday
+
+# The relatives in an SQLite database instead of one Markdown file each.
+# Keys are hashes, stamps the modification time and the revision of the
+# commit that wrote the record. The database runs in WAL mode, so the worker
+# processes keep reading while one of them writes.
+
+COLUMNS = [field for field in FIELDS if field != 'spouse']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS relatives (
+  hash TEXT PRIMARY KEY,
+''' + ''.join(f"  {column} TEXT NOT NULL DEFAULT '',\n" for column in COLUMNS[1:]) + '''
+  birthday_key TEXT NOT NULL DEFAULT '',
+  extra TEXT NOT NULL DEFAULT '{}',
+  body TEXT NOT NULL DEFAULT '',
+  modified INTEGER NOT NULL,
+  revision INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS spouses (
+  hash TEXT NOT NULL,
+  position INTEGER NOT NULL,
+  spouse TEXT NOT NULL,
+  PRIMARY KEY (hash, position)
+);
+CREATE TABLE IF NOT EXISTS generation (
+  id INTEGER PRIMARY KEY CHECK (id = 0),
+  revision INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO generation VALUES (0, 0);
+CREATE INDEX IF NOT EXISTS relatives_father ON relatives (father);
+CREATE INDEX IF NOT EXISTS relatives_mother ON relatives (mother);
+CREATE INDEX IF NOT EXISTS relatives_name ON relatives (name);
+CREATE INDEX IF NOT EXISTS relatives_birthday ON relatives (birthday_key, hash);
+CREATE INDEX IF NOT EXISTS spouses_spouse ON spouses (spouse);
+'''
+
+INSERT = (f'INSERT OR REPLACE INTO relatives ({", ".join(COLUMNS)}, birthday_key, extra, body, modified, revision) '
+          f'VALUES ({", ".join("?" * (len(COLUMNS) + 5))})')
+
+
+class SQLiteStorage:
+  def __init__(self, path):
+    self.path = path
+    self._local = threading.local()
+
+  def connection(self):
+    # One connection per thread, and none inherited from the process that
+    # forked the workers
+    local = self._local
+    if getattr(local, 'pid', None) != os.getpid():
+      dir.createDirIfNeeded(os.path.dirname(self.path) or '.')
+      connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+      if not connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'generation'").fetchone():
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.executescript(SCHEMA)
+      # Databases made before the front matter keys outside FIELDS were kept
+      if 'extra' not in [column for _, column, *_ in connection.execute('PRAGMA table_info(relatives)')]:
+        connection.execute("ALTER TABLE relatives ADD COLUMN extra TEXT NOT NULL DEFAULT '{}'")
+      local.connection, local.pid = connection, os.getpid()
+    return local.connection
+
+  def lock(self):
+    return file_lock(self.path + '.lock')
+
+  def generation(self):
+    return self.connection().execute('SELECT revision FROM generation').fetchone()[0]
+
+  def touch(self):
+    # Every commit moves the generation on
+    return self.generation()
+
+  def interrupted(self):
+    # SQLite rolls back unfinished transactions itself
+    return False
+
+  def recover(self):
+    return []
+
+  def scan(self):
+    rows = self.connection().execute('SELECT hash, modified, revision FROM relatives').fetchall()
+    return [(hash, (modified, revision)) for hash, modified, revision in rows]
+
+  def stamp(self, key):
+    row = self.connection().execute('SELECT modified, revision FROM relatives WHERE hash = ?', (key,)).fetchone()
+    return row and tuple(row)
+
+  def load(self, key, stamp):
+    connection = self.connection()
+    row = connection.execute(f'SELECT {", ".join(COLUMNS)}, extra FROM relatives WHERE hash = ?', (key,)).fetchone()
+    if row is None:
+      return None, None
+    count('records_read')
+    relative = Relative(json.loads(row[-1]))
+    relative.update(zip(COLUMNS, row))
+    relative['spouse'] = [spouse for spouse, in connection.execute(
+      'SELECT spouse FROM spouses WHERE hash = ? ORDER BY position', (key,))]
+    relative.set_source(self, key, stamp, None)
+    return relative, None
+
+  def read_body(self, key, stamp, hint):
+    count('records_read')
+    row = self.connection().execute('SELECT body FROM relatives WHERE hash = ?', (key,)).fetchone()
+    return row[0] if row else ''
+
+  def key(self, hash):
+    return hash
+
+  def hash(self, key):
+    return key
+
+  def commit(self, relatives, removes=(), fsync=True):
+    # Without fsync, the commit is durable once the next checkpoint ran
+    connection = self.connection()
+    connection.execute(f'PRAGMA synchronous = {"FULL" if fsync else "NORMAL"}')
+    modified = time.time_ns()
+    written = set()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      revision = connection.execute('SELECT revision FROM generation').fetchone()[0] + 1
+      for relative in relatives:
+        hash = relative['hash']
+        extra = json.dumps(getattr(relative, 'extra', None) or {}, ensure_ascii=False)
+        connection.execute(INSERT, [relative[column] for column in COLUMNS] +
+                                   [get_birthday(relative), extra, relative['body'], modified, revision])
+        connection.execute('DELETE FROM spouses WHERE hash = ?', (hash,))
+        connection.executemany('INSERT INTO spouses VALUES (?, ?, ?)',
+                               [(hash, position, spouse) for position, spouse in enumerate(relative['spouse'])])
+        written.add(hash)
+      removed = set(removes) - written
+      for hash in removed:
+        connection.execute('DELETE FROM relatives WHERE hash = ?', (hash,))
+        connection.execute('DELETE FROM spouses WHERE hash = ?', (hash,))
+      connection.execute('UPDATE generation SET revision = ?', (revision,))
+      connection.execute('COMMIT')
+    except BaseException:
+      connection.execute('ROLLBACK')
+      raise
+    return sorted(written | removed)
@@ -0,0 +1,87 @@
+from html import escape
+
+from genealogy.layout import CARD_HEIGHT, CARD_WIDTH
+
+# SVG user units are millimetres, the chart itself is laid out in cm
+SCALE = 10
+MARGIN = 5
+FONT_SIZE = 2.6
+LINE_HEIGHT = 3.2
+
+# The TikZ colors blue!70!white and blue!10!white etc.
+BORDER = {'male': '#4d4dff', 'female': '#ff4d4d'}
+FILL = {'male': '#e6e6ff', 'female': '#ffe6e6'}
+NEUTRAL_BORDER = '#4d4d4d'
+NEUTRAL_FILL = '#e6e6e6'
+
+
+def card_lines(relative):
+  # The lines of the text box below the portrait, as (text, style)
+  lines = [(relative['name'], 'bold')]
+  for symbol, day, place in [('*', 'birthday', 'birthplace'),
+                             ('⚭', 'weddingDay', 'weddingPlace'),
+                             ('†', 'dayOfDeath', 'placeOfDeath')]:
+    if relative[day] or relative[place]:
+      line = symbol
+      if relative[day]:
+        line += f' {relative[day]}'
+      if relative[place]:
+        line += f' in {relative[place]}'
+      lines.append((line, 'normal'))
+  if relative['profession']:
+    lines.append((relative['profession'], 'italic'))
+  return lines
+
+def svg_card(relative, x, y, image_url):
+  # (x, y) is the center of the card in svg units
+  width, height = CARD_WIDTH * SCALE, CARD_HEIGHT * SCALE
+  left, top = x - width / 2, y - height / 2
+  border = BORDER.get(relative['sex'], NEUTRAL_BORDER)
+  fill = FILL.get(relative['sex'], NEUTRAL_FILL)
+
+  # A nested svg element clips the portrait and overlong text to the card
+  parts = [f'<svg x="{left}" y="{top}" width="{width}" height="{height}">',
+           f'<rect width="{width}" height="{height}" fill="white"/>']
+  url = image_url(relative['image'])
+  if url:
+    parts.append(f'<image href="{escape(url)}" width="{width}" height="{height * 2 / 3}" '
+                 f'preserveAspectRatio="xMidYMid slice"/>')
+  parts.append(f'<rect y="{height * 2 / 3}" width="{width}" height="{height / 3}" fill="{fill}"/>')
+  for i, (text, style) in enumerate(card_lines(relative)):
+    weight = ' font-weight="bold"' if style == 'bold' else ''
+    slant = ' font-style="italic"' if style == 'italic' else ''
+    parts.append(f'<text x="2" y="{height * 2 / 3 + 2 + (i + 1) * LINE_HEIGHT}"{weight}{slant}>{escape(text)}</text>')
+  parts.append('</svg>')
+  parts.append(f'<rect x="{left}" y="{top}" width="{width}" height="{height}" rx="2" fill="none" '
+               f'stroke="{border}" stroke-width="1"/>')
+  return ''.join(parts)
+
+def render_svg(chart, relatives, image_url):
+  left, bottom, right, top = chart.bounds()
+
+  def point(x, y):
+    # TikZ's y axis points up, SVG's points down
+    return (x - left) * SCALE + MARGIN, (top - y) * SCALE + MARGIN
+
+  width = (right - left) * SCALE + 2 * MARGIN
+  height = (top - bottom) * SCALE + 2 * MARGIN
+  nodes = {node['id']: node for node in chart.nodes}
+  hubs = {hub['id']: hub for hub in chart.hubs}
+
+  # Connections go from a card vertically to the height of the hub and then
+  # horizontally to it, like TikZ's |- path operation
+  paths = []
+  for node_id, hub_id in chart.links:
+    x1, y1 = point(nodes[node_id]['x'], nodes[node_id]['y'])
+    x2, y2 = point(hubs[hub_id]['x'], hubs[hub_id]['y'])
+    paths.append(f'M{x1} {y1}V{y2}H{x2}')
+  path = ''.join(paths)
+
+  parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}mm" height="{height}mm" '
+           f'viewBox="0 0 {width} {height}" font-family="sans-serif" font-size="{FONT_SIZE}">',
+           f'<path d="{path}" fill="none" stroke="white" stroke-width="4"/>',
+           f'<path d="{path}" fill="none" stroke="black" stroke-width="2"/>']
+  for node in chart.nodes:
+    parts.append(svg_card(relatives[node['hash']], *point(node['x'], node['y']), image_url))
+  parts.append('</svg>\n')
+  return '\n'.join(parts)
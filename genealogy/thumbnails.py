@@ -0,0 +1,120 @@
+import hashlib
+import os
+
+from flask import g, url_for
+
+from genealogy import dir
+from genealogy.metrics import count, span
+from genealogy.relatives import file_stamp
+
+try:
+  from PIL import Image, ImageOps, features
+except ImportError:
+  Image = None
+
+
+IMAGE_DIR = 'data/relatives/images/'
+
+# Derivatives are stored as THUMBNAIL_DIR/<image>/<width>-<version>.<format>,
+# the version changes with the source file
+THUMBNAIL_DIR = 'data/cache/thumbnails/'
+WIDTHS = (320, 640, 1280)
+QUALITY = 80
+MAX_AGE = 365 * 24 * 3600
+FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg')}
+
+
+def source_path(image):
+  # Thumbnails are only made of files below IMAGE_DIR
+  root = os.path.abspath(IMAGE_DIR)
+  path = os.path.abspath(os.path.join(root, image))
+  if not path.startswith(root + os.sep) or not os.path.isfile(path):
+    return None
+  return path
+
+def stamp(image):
+  path = source_path(image)
+  return path and file_stamp(path)
+
+def version(image):
+  image_stamp = stamp(image)
+  if not image_stamp:
+    return None
+  return hashlib.sha256(f'{image}\0{image_stamp}'.encode('utf-8')).hexdigest()[:16]
+
+def referenced(image):
+  # Cached pages have to change with the images they link to, see
+  # genealogy.pagecache
+  images = g.get('page_images')
+  if images is not None:
+    images.add(image)
+
+def available():
+  return Image is not None
+
+def accepted_format(accept_mimetypes):
+  if accept_mimetypes['image/webp'] and features.check('webp'):
+    return 'webp'
+  return 'jpeg'
+
+def thumbnail(image, width, format):
+  # Returns the path of the derivative and its version, or (None, None)
+  source = source_path(image)
+  if source is None:
+    return None, None
+  key = version(image)
+  directory = os.path.join(THUMBNAIL_DIR, image)
+  path = os.path.join(directory, f'{width}-{key}.{format}')
+  if os.path.exists(path):
+    count('thumbnail_hits')
+    return path, key
+
+  count('thumbnail_misses')
+  dir.createDirIfNeeded(directory)
+  with span('thumbnail'):
+    render(source, path, width, format)
+
+  # Drop the derivatives of older versions of the source
+  for entry in os.scandir(directory):
+    if entry.name.startswith(f'{width}-') and entry.name.endswith(f'.{format}') and entry.path != path:
+      try:
+        os.remove(entry.path)
+      except OSError:
+        pass
+  return path, key
+
+def render(source, path, width, format):
+  with Image.open(source) as original:
+    image = ImageOps.exif_transpose(original)
+    if image.width > width:
+      image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+    if format == 'jpeg' and image.mode != 'RGB':
+      # JPEG has no alpha channel, flatten transparent images onto white
+      image = image.convert('RGBA')
+      background = Image.new('RGB', image.size, 'white')
+      background.paste(image, mask=image.getchannel('A'))
+      image = background
+    elif image.mode not in ('RGB', 'RGBA'):
+      image = image.convert('RGBA')
+
+    # Several workers may render the same derivative at once
+    with dir.replaceFile(path, 'wb') as f:
+      if format == 'jpeg':
+        image.save(f, FORMATS[format][0], quality=QUALITY, optimize=True, progressive=True)
+      else:
+        image.save(f, FORMATS[format][0], quality=QUALITY, method=4)
+
+def thumbnail_url(image, width):
+  referenced(image)
+  key = version(image) if available() else None
+  if key is None:
+    return url_for('static', filename=f'images/relatives/{image}')
+  return url_for('thumbnail', width=width, image=image, v=key)
+
+def thumbnail_srcset(image):
+  referenced(image)
+  key = version(image) if available() else None
+  if key is None:
+    return ''
+  return ', '.join(f'{url_for("thumbnail", width=width, image=image, v=key)} {width}w' for width in WIDTHS)
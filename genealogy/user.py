@@ -1,10 +1,12 @@
 import os
 import secrets
+import threading
 
 import flask_login
 from flask import redirect, url_for
 
 from genealogy import dir, login_manager
+from genealogy.relatives import file_stamp
 
 
 class User(flask_login.UserMixin):
@@ -13,30 +15,54 @@ class User(flask_login.UserMixin):
     self.id = email
     self.role = role
 
+DIR = 'data/login/'
+FILENAME = 'login.md'
+
+# login.md is only parsed again when its mtime or size changes
+_cache = {'stamp': None, 'users': {}, 'tokens': {}}
+_lock = threading.Lock()
+
 def load_users():
-  DIR = 'data/login/'
-  filename = 'login.md'
-  dir.createFileIfNeeded(DIR, filename)
-
-  users = {}
-  with open(os.path.join(DIR, filename)) as file:
-    for line in file:
-      fields = line.rstrip().split(';')
-      if len(fields) != 4:
-        continue
-      email = fields[2]
-      users[email] = {'role': fields[0], 'name': fields[1], 'password': fields[3]}
-  return users
+  filename = os.path.join(DIR, FILENAME)
+  stamp = file_stamp(filename)
+  if stamp is None:
+    dir.createFileIfNeeded(DIR, FILENAME)
+    stamp = file_stamp(filename)
+
+  with _lock:
+    if stamp == _cache['stamp']:
+      return _cache['users']
+
+    users = {}
+    tokens = {}
+    with open(filename) as file:
+      for line in file:
+        fields = line.rstrip().split(';')
+        if len(fields) != 4:
+          continue
+        email = fields[2]
+        users[email] = {'role': fields[0], 'name': fields[1], 'password': fields[3]}
+        tokens[fields[3]] = email
+    _cache.update(stamp=stamp, users=users, tokens=tokens)
+    return users
+
+def find_user_by_token(token):
+  users = load_users()
+  email = _cache['tokens'].get(token)
+  if email is None or users.get(email, {}).get('password') != token:
+    return None, None
+  return email, users[email]
 
 def add_new_user(name, email):
-  DIR = 'data/login/'
-  filename = 'login.md'
-  dir.createFileIfNeeded(DIR, filename)
+  dir.createFileIfNeeded(DIR, FILENAME)
 
   password = secrets.token_hex()
-  with open(os.path.join(DIR, filename), 'a') as file:
+  with open(os.path.join(DIR, FILENAME), 'a') as file:
       file.write(f'inactive;{name};{email};{password}\n')
 
+  with _lock:
+    _cache['stamp'] = None
+
 @login_manager.user_loader
 def user_loader(email):
   users = load_users()
@@ -0,0 +1,182 @@
+import re
+
+
+# Checks of the relatives' data. The findings of a person only depend on
+# their own record and those of their parents, spouses and the people on a
+# parent cycle with them, so after a change only the changed people, their
+# children, the people listing them as spouse and their cycles are checked
+# again.
+
+def parse_date(text):
+  # DD.MM.YYYY, MM.YYYY or YYYY as a (year, month, day) prefix, None for
+  # anything else
+  match = re.fullmatch(r'(?:(?:(\d{1,2})\.)?(\d{1,2})\.)?(\d{3,4})', text.strip())
+  if not match:
+    return None
+  day, month, year = match.groups()
+  return tuple(int(part) for part in (year, month, day) if part is not None)
+
+def before(a, b):
+  # Whether date a is certainly before date b, compared to the precision of
+  # the less precise one
+  a, b = parse_date(a), parse_date(b)
+  if a is None or b is None:
+    return False
+  n = min(len(a), len(b))
+  return a[:n] < b[:n]
+
+def reachable(step, hash):
+  seen = set()
+  stack = [hash]
+  while stack:
+    for relative in step(stack.pop()):
+      if relative and relative not in seen:
+        seen.add(relative)
+        stack.append(relative)
+  return seen
+
+def parent_cycles(kinship, hashes):
+  # Tarjan's algorithm over the parent links reachable from hashes, without
+  # recursion. Maps everybody on a cycle to the people on that cycle.
+  parents = lambda person: [parent for parent in kinship.parents.get(person, ()) if parent]
+  index = {}
+  low = {}
+  stack = []
+  on_stack = set()
+  cycles = {}
+
+  def visit(person):
+    index[person] = low[person] = len(index)
+    stack.append(person)
+    on_stack.add(person)
+    return person, iter(parents(person))
+
+  for root in hashes:
+    if root in index:
+      continue
+    work = [visit(root)]
+    while work:
+      person, remaining = work[-1]
+      for parent in remaining:
+        if parent not in index:
+          work.append(visit(parent))
+          break
+        if parent in on_stack:
+          low[person] = min(low[person], index[parent])
+      else:
+        work.pop()
+        if work:
+          low[work[-1][0]] = min(low[work[-1][0]], low[person])
+        if low[person] == index[person]:
+          component = set()
+          while True:
+            member = stack.pop()
+            on_stack.discard(member)
+            component.add(member)
+            if member == person:
+              break
+          if len(component) > 1 or person in parents(person):
+            component = frozenset(component)
+            for member in component:
+              cycles[member] = component
+  return cycles
+
+def check_dates(relative, father, mother, children):
+  # father and mother are records or None, children a list of records
+  hash = relative['hash']
+  findings = []
+  if before(relative['dayOfDeath'], relative['birthday']):
+    findings.append(f'{hash} died before they were born')
+  for role, parent in [('father', father), ('mother', mother)]:
+    if parent is not None and before(relative['birthday'], parent['birthday']):
+      findings.append(f'{hash} was born before their {role} {parent["hash"]}')
+  for child in children:
+    if before(child['birthday'], relative['birthday']):
+      findings.append(f'{child["hash"]} was born before their parent {hash}')
+  return findings
+
+def check(relative, relatives, cycle):
+  hash = relative['hash']
+  findings = []
+  for role in ('father', 'mother'):
+    if relative[role] and relative[role] not in relatives:
+      findings.append(f'{hash} has an invalid cross-reference to their {role} {relative[role]}')
+  for spouse in relative['spouse']:
+    if not spouse:
+      findings.append(f'{hash} contains an empty spouse entry')
+    elif spouse not in relatives:
+      findings.append(f'{hash} has an invalid cross-reference to their spouse {spouse}')
+    elif hash not in relatives[spouse]['spouse']:
+      findings.append(f'{spouse} is missing a cross-reference to their spouse {hash}')
+
+  # Children are checked against their parents, not the other way round
+  findings += check_dates(relative, relatives.get(relative['father']), relatives.get(relative['mother']), [])
+  if cycle == {hash}:
+    findings.append(f'{hash} is their own parent')
+  elif cycle:
+    findings.append(f'{hash} is their own ancestor via {", ".join(sorted(cycle - {hash}))}')
+  return findings
+
+class Validator:
+  def __init__(self):
+    self.findings = {} # hash -> list of findings
+    self.files = {}    # filename -> finding about the file itself
+    self.cycles = {}   # hash -> people on a parent cycle with it
+    self.dirty = set() # hashes changed since the last update
+
+  def changed(self, hash):
+    self.dirty.add(hash)
+
+  def file_changed(self, filename, relative, hash):
+    # hash is the one the filename stands for
+    self.files.pop(filename, None)
+    if relative is None:
+      self.files[filename] = 'Failed to read ' + filename
+    elif relative['hash'] != hash:
+      self.files[filename] = 'Wrong filename ' + filename
+
+  def file_removed(self, filename):
+    self.files.pop(filename, None)
+
+  def update(self, relatives, kinship):
+    if not self.dirty:
+      return
+    affected = set()
+    for hash in self.dirty:
+      affected |= {hash} | kinship.children_of(hash) | kinship.spouse_of(hash) | self.cycles.get(hash, frozenset())
+    cycles = parent_cycles(kinship, affected)
+    for hash in self.dirty:
+      affected |= cycles.get(hash, frozenset())
+    self.dirty = set()
+
+    for hash in affected:
+      self.findings.pop(hash, None)
+      self.cycles.pop(hash, None)
+      relative = relatives.get(hash)
+      if relative is None:
+        continue
+      cycle = cycles.get(hash)
+      if cycle:
+        self.cycles[hash] = cycle
+      findings = check(relative, relatives, cycle)
+      if findings:
+        self.findings[hash] = findings
+
+  def warnings(self):
+    warnings = sorted(self.files.values())
+    for hash in sorted(self.findings):
+      warnings += self.findings[hash]
+    return warnings
+
+def check_edit(relative, old_hash, relatives, kinship):
+  # Problems a changed record would introduce, before it is written: a
+  # parent cycle or impossible dates. The record may be renamed from old_hash.
+  hash = relative['hash']
+  parents = lambda person: kinship.parents.get(person, ()) if person not in (hash, old_hash) else (relative['father'], relative['mother'])
+  errors = []
+  if {hash, old_hash} & reachable(parents, hash):
+    errors.append(f'{hash} would be their own ancestor')
+
+  children = [relatives[child] for child in kinship.children_of(old_hash) if child in relatives and child not in (hash, old_hash)]
+  errors += check_dates(relative, relatives.get(relative['father']), relatives.get(relative['mother']), children)
+  return errors
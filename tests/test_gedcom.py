@@ -0,0 +1,46 @@
+import io
+import os
+
+import pytest
+
+from genealogy import gedcom, relatives
+from genealogy.relatives import open_repository
+
+HOSTILE = '''0 HEAD
+0 @../../evil@ INDI
+0 @I 2@ INDI
+1 NAME Max /Muster/
+0 @/etc/passwd@ INDI
+1 NAME ../..
+0 @..@ INDI
+0 TRLR
+'''
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  repository = open_repository('markdown')
+  monkeypatch.setattr(relatives, 'repository', repository)
+  monkeypatch.setattr(gedcom, 'repository', repository)
+  return repository
+
+def test_hostile_xrefs(repository, tmp_path):
+  imported, _ = gedcom.import_gedcom(io.StringIO(HOSTILE))
+  assert imported == 4
+
+  hashes = sorted(relative['hash'] for relative in repository.sorted())
+  assert hashes == ['etc-passwd', 'evil', 'max-muster-i-2', 'relative']
+  assert all(gedcom.HASH.fullmatch(hash) for hash in hashes)
+  files = sorted(os.path.relpath(os.path.join(root, name), tmp_path)
+                 for root, _, names in os.walk(tmp_path) for name in names if name.endswith('.md'))
+  assert files == [os.path.join('data', 'relatives', f'{hash}.md') for hash in hashes]
+
+def test_invalid_refn_is_not_used(repository):
+  text = '0 @I1@ INDI\n1 NAME Max /Muster/\n1 REFN ../evil\n2 TYPE genealogy\n'
+  gedcom.import_gedcom(io.StringIO(text))
+  assert [relative['hash'] for relative in repository.sorted()] == ['max-muster-i1']
+
+def test_invalid_hash_is_rejected():
+  with pytest.raises(ValueError):
+    gedcom.checked_hash('../evil')